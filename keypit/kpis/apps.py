@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class KpisConfig(AppConfig):
     name = 'keypit.kpis'
+
+    def ready(self):
+        from . import caching  # noqa: F401, registers the report cache check
@@ -0,0 +1,180 @@
+from django.conf import settings
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from datetime import date
+import json
+import os
+import random
+import time
+import tracemalloc
+
+from . import caching, stats
+from .models import KPI, KPICategory, KPIEntry, KPIFamily, Manager, Unit, UnitType, refresh_unit_entries
+
+BENCHMARK_BASELINES = getattr(settings, 'BENCHMARK_BASELINES', os.path.join(os.path.dirname(__file__), 'benchmarks.json'))
+BENCHMARK_TOLERANCE = getattr(settings, 'BENCHMARK_TOLERANCE', 1.5)
+
+
+def generate(depth=3, width=3, kpis=12, categories=3, families=2, years=2, seed=1):
+    """
+    Create a synthetic facility: a tree of units with width children per unit down to depth levels below
+    the root, the given number of KPI categories, KPIs and families, and monthly entries for the KPIs of
+    every reporting unit (the leaves) over the given number of years up to the current one.
+    Returns a dictionary with the root unit, a reporting unit and a KPI for the benchmarks.
+    """
+    rng = random.Random(seed)
+    kinds = [
+        UnitType.objects.create(name='Level {}'.format(level), reporter=(level == depth)) for level in range(depth + 1)
+    ]
+    root = Unit.tree.create(name='Facility', acronym='FAC', kind=kinds[0])
+    levels = [[root]]
+    for level in range(1, depth + 1):
+        levels.append([
+            Unit.tree.create(
+                name='{} Unit {}'.format(parent.name, i), acronym='{}-{}'.format(parent.acronym, i),
+                kind=kinds[level], parent=parent
+            ) for parent in levels[-1] for i in range(width)
+        ])
+
+    cats = [
+        KPICategory.objects.create(name='Category {}'.format(i), description='Goal {}'.format(i), priority=i)
+        for i in range(categories)
+    ]
+    indicators = []
+    for i in range(kpis):
+        kpi = KPI.objects.create(
+            name='KPI {}'.format(i), description='Indicator {}'.format(i), category=cats[i % len(cats)],
+            kind=[KPI.TYPE.SUM, KPI.TYPE.AVERAGE, KPI.TYPE.SUM, KPI.TYPE.TEXT][i % 4], priority=i
+        )
+        # assign KPIs to units below the root, which does not pass its KPIs on to its descendants
+        kpi.units.add(rng.choice(levels[1 + i % depth]))
+        indicators.append(kpi)
+    numeric = [kpi for kpi in indicators if kpi.kind != KPI.TYPE.TEXT]
+    for i in range(families):
+        family = KPIFamily.objects.create(name='Family {}'.format(i), kind=i % 2)
+        family.kpis.add(*numeric[2 * i:2 * i + 2])
+
+    this_year = date.today().year
+    months = [date(year, month, 1) for year in range(this_year - years + 1, this_year + 1) for month in range(1, 13)]
+    entries = []
+    for unit in levels[-1]:
+        for kpi in unit.indicators().distinct():
+            for month in months:
+                entries.append(KPIEntry(
+                    unit=unit, kpi=kpi, month=month,
+                    value=kpi.kind != KPI.TYPE.TEXT and rng.choice([None, rng.randint(0, 100)]) or None,
+                    comments=rng.random() < 0.2 and 'Comment on {} for {}'.format(kpi.name, month) or ''
+                ))
+    KPIEntry.objects.bulk_create(entries, batch_size=1000)
+    refresh_unit_entries(entries)
+    return {'root': root, 'unit': levels[-1][0], 'kpi': indicators[0], 'year': this_year}
+
+
+def measure(func, setup=None, repeat=3):
+    """
+    Run func repeat times, calling setup before each run, and return the number of queries of the first
+    run and the lowest wall-clock time in milliseconds and peak memory allocation in kilobytes of all runs,
+    so that one-off costs such as compiling templates are not counted.
+    """
+    result = {'queries': None, 'time': None, 'memory': None}
+    for i in range(repeat):
+        if setup:
+            setup()
+        tracemalloc.start()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            func()
+            elapsed = (time.perf_counter() - start) * 1000
+        peak = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+        result['queries'] = len(queries) if result['queries'] is None else result['queries']
+        result['time'] = round(min(elapsed, result['time'] or elapsed), 2)
+        result['memory'] = round(min(peak, result['memory'] or peak), 1)
+    return result
+
+
+def scenarios(data):
+    """
+    The report functions and pages to benchmark for data returned by generate()
+    """
+    root, unit, kpi, year = data['root'], data['unit'], data['kpi'], data['year']
+    subtree = [root] + root.descendants()
+    user = Manager.objects.filter(username='benchmark').first() or Manager.objects.create_superuser(
+        username='benchmark', email='', password=None
+    )
+    client = Client()
+    client.force_login(user)
+
+    def page(name, **kwargs):
+        url = reverse(name, kwargs=kwargs)
+
+        def get():
+            response = client.get(url)
+            assert response.status_code == 200, '{} returned {}'.format(url, response.status_code)
+        return get
+
+    return {
+        'unit_stats_years': lambda: stats.unit_stats(period='year', unit__in=subtree),
+        'unit_stats_months': lambda: stats.unit_stats(
+            period='month', year=year, unit__in=subtree, **stats.month_range(year)
+        ),
+        'unit_stats_subtree': lambda: stats.unit_stats(
+            period='month', year=year, subtree=root, unit__in=subtree, **stats.month_range(year)
+        ),
+        'kpi_stats': lambda: stats.unit_stats(period='year', kpi=kpi),
+        'dashboard': page('dashboard'),
+        'unit_detail': page('unit-year', pk=root.pk, year=year, period='month'),
+        'unit_report': page('unit-report', pk=unit.pk, year=year, month=1),
+    }
+
+
+def run(data, repeat=3, only=None):
+    # reports are cached, so each run starts from an empty report cache
+    return {
+        name: measure(func, setup=caching.invalidate_reports, repeat=repeat)
+        for name, func in scenarios(data).items() if not only or name in only
+    }
+
+
+def load_baselines(path=BENCHMARK_BASELINES):
+    """
+    Baselines are stored per database vendor, as {vendor: {scenario: {'queries', 'time', 'memory'}}}
+    """
+    try:
+        with open(path) as f:
+            return json.load(f).get(connection.vendor, {})
+    except (OSError, ValueError):
+        return {}
+
+
+def save_baselines(results, path=BENCHMARK_BASELINES):
+    try:
+        with open(path) as f:
+            baselines = json.load(f)
+    except (OSError, ValueError):
+        baselines = {}
+    baselines[connection.vendor] = results
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+
+
+def compare(results, baselines, tolerance=BENCHMARK_TOLERANCE):
+    """
+    Return a message for every scenario which has no baseline, makes more queries than its baseline, or takes
+    more time or memory than tolerance times its baseline
+    """
+    failures = []
+    for name, result in sorted(results.items()):
+        baseline = baselines.get(name)
+        if not baseline:
+            failures.append('{}: no {} baseline'.format(name, connection.vendor))
+            continue
+        if result['queries'] > baseline['queries']:
+            failures.append('{}: {} queries, baseline {}'.format(name, result['queries'], baseline['queries']))
+        for key, unit in [('time', 'ms'), ('memory', 'KB')]:
+            if result[key] > baseline[key] * tolerance:
+                failures.append('{}: {}{} {}, baseline {}{}'.format(name, result[key], unit, key, baseline[key], unit))
+    return failures
@@ -0,0 +1,117 @@
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.db.models import Model
+
+import hashlib
+import time
+
+HOUR_SECONDS = 3600
+
+REPORT_CACHE = getattr(settings, 'REPORT_CACHE', 'default')
+REPORT_CACHE_SIZE = getattr(settings, 'REPORT_CACHE_SIZE', 250)
+REPORT_CACHE_TIMEOUT = getattr(settings, 'REPORT_CACHE_TIMEOUT', 24 * HOUR_SECONDS)
+
+GENERATION_KEY = 'keypit:reports:generation'
+
+
+def report_cache():
+    return caches[REPORT_CACHE]
+
+
+@checks.register(checks.Tags.caches)
+def check_report_cache(app_configs, **kwargs):
+    """
+    Warn if the report cache is private to each process, where invalidate_reports() does not reach the
+    reports cached by other processes.
+    """
+    backend = settings.CACHES.get(REPORT_CACHE, {}).get('BACKEND', '')
+    if backend.endswith(('.LocMemCache', '.DummyCache')):
+        return [checks.Warning(
+            'The report cache "{}" is not shared between processes, so other processes keep serving reports '
+            'which are out of date.'.format(REPORT_CACHE),
+            hint='Set REPORT_CACHE to a file, memcached or redis cache in CACHES.',
+            id='kpis.W001',
+        )]
+    return []
+
+
+def generation():
+    """
+    Current report generation. Every cached report is stored under the generation in which it was computed,
+    so bumping the generation invalidates all reports at once. A generation evicted from the cache restarts
+    from the current time, so that it never returns to the generation of reports still in the cache.
+    """
+    cache = report_cache()
+    gen = cache.get(GENERATION_KEY)
+    if gen is None:
+        cache.add(GENERATION_KEY, int(time.time() * 1000), timeout=None)
+        gen = cache.get(GENERATION_KEY, 1)
+    return gen
+
+
+def invalidate_reports():
+    """
+    Start a new report generation. Reports of previous generations are never read again and expire after
+    REPORT_CACHE_TIMEOUT, together with their usage records.
+    """
+    cache = report_cache()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, int(time.time() * 1000), timeout=None)
+
+
+def key_value(value):
+    """
+    A stable representation of a report argument. Model instances are reduced to their primary keys
+    so that the key does not depend on __str__ or on the order of unit lists.
+    """
+    if isinstance(value, Model):
+        return '{}:{}'.format(value._meta.label_lower, value.pk)
+    elif isinstance(value, (list, tuple, set, frozenset)) or hasattr(value, 'values_list'):
+        return sorted(key_value(v) for v in value)
+    return value
+
+
+def report_key(**kwargs):
+    parts = repr(sorted((k, key_value(v)) for k, v in kwargs.items()))
+    return 'keypit:reports:{}:{}'.format(generation(), hashlib.md5(parts.encode('utf-8')).hexdigest())
+
+
+def touch(key):
+    """
+    Record a use of the report stored under key and evict the reports of its generation which have not
+    been used in the last REPORT_CACHE_SIZE uses. Uses are numbered with cache.incr() and recorded in a ring
+    of REPORT_CACHE_SIZE slots, so concurrent requests do not overwrite each other's bookkeeping. The counter
+    is atomic on memcached and redis. Elsewhere, a lost update can at worst evict a report early.
+    """
+    cache = report_cache()
+    prefix = key.rsplit(':', 1)[0]      # keypit:reports:<generation>
+    counter = '{}:uses'.format(prefix)
+    cache.add(counter, 0, timeout=REPORT_CACHE_TIMEOUT)
+    try:
+        use = cache.incr(counter)
+    except ValueError:
+        return
+
+    # the slot was last written REPORT_CACHE_SIZE uses ago, evict its report unless it was used since
+    slot = '{}:slot:{}'.format(prefix, use % REPORT_CACHE_SIZE)
+    previous = cache.get(slot)
+    if previous and previous[0] != key and cache.get('{}:use'.format(previous[0])) == previous[1]:
+        cache.delete_many([previous[0], '{}:use'.format(previous[0])])
+    cache.set_many({slot: (key, use), '{}:use'.format(key): use}, timeout=REPORT_CACHE_TIMEOUT)
+
+
+def cached_report(func, **kwargs):
+    """
+    Return func(**kwargs) from the report cache, computing and storing it on a miss.
+    """
+    cache = report_cache()
+    key = report_key(report=func.__name__, **kwargs)
+    report = cache.get(key)
+    if report is None:
+        report = func(**kwargs)
+        cache.set(key, report, timeout=REPORT_CACHE_TIMEOUT)
+    touch(key)
+    return report
@@ -0,0 +1,142 @@
+from django.conf import settings
+
+from collections import Counter
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+import logging
+logger = logging.getLogger(__name__)
+
+HTTP_CACHE_DIR = getattr(settings, 'HTTP_CACHE_DIR', os.path.join(settings.LOCAL_DIR, 'cache', 'http'))
+HTTP_CACHE_TTL = getattr(settings, 'HTTP_CACHE_TTL', 3600)
+HTTP_TIMEOUT = getattr(settings, 'HTTP_TIMEOUT', 30)
+HTTP_POOL_HOSTS = getattr(settings, 'HTTP_POOL_HOSTS', 4)
+HTTP_POOL_SIZE = getattr(settings, 'HTTP_POOL_SIZE', 8)
+
+
+class CachedResponse(object):
+    """
+    The parts of a requests.Response used by KeyPIT, as returned from the network or the response cache.
+    """
+
+    def __init__(self, url, status_code, content, headers, cached=False):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.cached = cached
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class APIClient(object):
+    """
+    HTTP client for the external (USO and People) APIs. Connections are pooled per host and successful GET
+    responses are cached on disk. Fresh responses are served without a request for ttl seconds, after which
+    they are revalidated with If-None-Match/If-Modified-Since when the server provided an ETag or
+    Last-Modified header. Hits, misses and revalidations are counted in stats.
+    """
+
+    def __init__(self, cache_dir=HTTP_CACHE_DIR, ttl=HTTP_CACHE_TTL, timeout=HTTP_TIMEOUT,
+                 pool_hosts=HTTP_POOL_HOSTS, pool_size=HTTP_POOL_SIZE):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.timeout = timeout
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def cache_path(self, url, headers):
+        key = hashlib.sha1(json.dumps([url, sorted((headers or {}).items())]).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def load(self, path):
+        try:
+            with open(path + '.json') as meta, open(path + '.body', 'rb') as body:
+                entry = json.load(meta)
+                entry['content'] = body.read()
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def store(self, path, entry):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = {k: v for k, v in entry.items() if k != 'content'}
+        for suffix, data in [('.body', entry['content']), ('.json', json.dumps(meta).encode('utf-8'))]:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path + suffix)
+
+    def get(self, url, headers=None, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        path = self.cache_path(url, headers)
+        entry = self.load(path)
+        if entry and time.time() - entry['fetched'] < ttl:
+            self.count('hits')
+            return CachedResponse(url, entry['status_code'], entry['content'], entry['headers'], cached=True)
+
+        request_headers = dict(headers or {})
+        if entry and entry['headers'].get('ETag'):
+            request_headers['If-None-Match'] = entry['headers']['ETag']
+        if entry and entry['headers'].get('Last-Modified'):
+            request_headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+
+        try:
+            r = self.session.get(url, headers=request_headers, timeout=self.timeout)
+        except requests.RequestException:
+            self.count('errors')
+            if entry:
+                logger.warning('Serving stale response for {}'.format(url))
+                return CachedResponse(url, entry['status_code'], entry['content'], entry['headers'], cached=True)
+            raise
+
+        if r.status_code == 304 and entry:
+            self.count('revalidated')
+            entry['fetched'] = time.time()
+            self.store(path, entry)
+            return CachedResponse(url, entry['status_code'], entry['content'], entry['headers'], cached=True)
+
+        self.count('misses')
+        response = CachedResponse(url, r.status_code, r.content, {
+            k: r.headers[k] for k in ['ETag', 'Last-Modified', 'Content-Type'] if k in r.headers
+        })
+        if r.status_code == 200 and ttl > 0:
+            self.store(path, {
+                'url': url, 'status_code': r.status_code, 'headers': response.headers,
+                'fetched': time.time(), 'content': r.content
+            })
+        return response
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    The APIClient shared by all KeyPIT code in this process
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = APIClient()
+    return _client
@@ -0,0 +1,109 @@
+from django.conf import settings
+
+from datetime import datetime
+import csv
+
+from .models import KPIEntry
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+EXPORT_FIELDS = ['unit', 'unit_name', 'category', 'kpi', 'month', 'value', 'comments']
+EXPORT_COLUMNS = ['unit__acronym', 'unit__name', 'kpi__category__name', 'kpi__name', 'month', 'value', 'comments']
+EXPORT_TYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def export_formats():
+    return [fmt for fmt, available in [('csv', True), ('xlsx', openpyxl), ('parquet', pyarrow)] if available]
+
+
+def parse_month(value):
+    return value and datetime.strptime(value, '%Y-%m').date() or None
+
+
+def export_rows(unit=None, kpi=None, category=None, start=None, end=None):
+    """
+    Iterate over (unit, unit_name, category, kpi, month, value, comments) tuples for all entries of the
+    subtree of unit, kpi and category between the start and end months (inclusive), fetched from a
+    server-side cursor in chunks of EXPORT_CHUNK_SIZE rows
+    """
+    entries = KPIEntry.objects.all()
+    if unit:
+        entries = entries.filter(unit__ancestor_links__ancestor=unit)
+    if kpi:
+        entries = entries.filter(kpi=kpi)
+    if category:
+        entries = entries.filter(kpi__category=category)
+    if start:
+        entries = entries.filter(month__gte=start)
+    if end:
+        entries = entries.filter(month__lte=end)
+    entries = entries.order_by('month', 'unit__acronym', 'kpi__category__priority', 'kpi__priority')
+    return entries.values_list(*EXPORT_COLUMNS).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+class Echo(object):
+    """
+    File-like object returning what is written to it, so csv.writer can produce rows for streaming
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def write_csv(rows, stream):
+    for line in csv_lines(rows):
+        stream.write(line.encode('utf-8'))
+
+
+def write_xlsx(rows, stream):
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet('KPI Entries')
+    sheet.append(EXPORT_FIELDS)
+    for row in rows:
+        sheet.append(row)
+    book.save(stream)
+
+
+def write_parquet(rows, stream):
+    schema = pyarrow.schema([
+        ('unit', pyarrow.string()), ('unit_name', pyarrow.string()), ('category', pyarrow.string()),
+        ('kpi', pyarrow.string()), ('month', pyarrow.date32()), ('value', pyarrow.int64()),
+        ('comments', pyarrow.string()),
+    ])
+    with pyarrow.parquet.ParquetWriter(stream, schema) as writer:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == EXPORT_CHUNK_SIZE:
+                writer.write_batch(pyarrow.RecordBatch.from_arrays(list(map(list, zip(*chunk))), schema=schema))
+                chunk = []
+        if chunk:
+            writer.write_batch(pyarrow.RecordBatch.from_arrays(list(map(list, zip(*chunk))), schema=schema))
+
+
+WRITERS = {
+    'csv': write_csv,
+    'xlsx': write_xlsx,
+    'parquet': write_parquet,
+}
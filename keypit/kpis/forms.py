@@ -7,6 +7,7 @@ from crispy_forms.bootstrap import StrictButton
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import HTML, Div, Field, Layout
 
+from .importer import EntryImport, IMPORT_FORMATS, read_rows
 from .models import KPI, KPIEntry, KPICategory, Unit
 
 
@@ -174,3 +175,51 @@ class KPICategoryForm(forms.ModelForm):
             StrictButton('Revert', type='reset', value='Reset', css_class="btn btn-secondary"),
             StrictButton('Save', type='submit', name="submit", value='save', css_class='btn btn-primary'),
         )
+
+
+class KPIEntryImportForm(forms.Form):
+    file = forms.FileField(help_text="CSV with the columns unit, kpi, month, value and comments, or JSON with those keys")
+    format = forms.ChoiceField(choices=[('', 'From file extension')] + [(f, f.upper()) for f in IMPORT_FORMATS],
+                               required=False)
+    dry_run = forms.BooleanField(required=False, label="Dry run, only report what would change")
+
+    MAX_ERRORS = 25
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.body = BodyHelper(self)
+        self.footer = FooterHelper(self)
+        self.body.title = u"Import KPI Entries"
+        self.body.form_action = reverse_lazy('kpientry-import')
+        self.body.layout = Layout(
+            Div(
+                Div('file', css_class="col-12"),
+                Div('format', css_class="col-6"),
+                Div('dry_run', css_class="col-12"),
+                css_class="row"
+            ),
+        )
+        self.footer.layout = Layout(
+            StrictButton('Revert', type='reset', value='Reset', css_class="btn btn-secondary"),
+            StrictButton('Import', type='submit', name="submit", value='save', css_class='btn btn-primary'),
+        )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        upload = cleaned_data.get('file')
+        if not upload:
+            return cleaned_data
+        fmt = cleaned_data.get('format') or upload.name.rsplit('.', 1)[-1].lower()
+        if fmt not in IMPORT_FORMATS:
+            raise forms.ValidationError("Unable to determine the file format, please select one")
+        try:
+            self.importer = EntryImport(read_rows(upload.read(), fmt))
+        except ValueError as e:
+            raise forms.ValidationError("Unable to read the file: {}".format(e))
+        if not self.importer.validate():
+            errors = ["Line {}: {}".format(line, error) for line, error in self.importer.errors[:self.MAX_ERRORS]]
+            if len(self.importer.errors) > self.MAX_ERRORS:
+                errors.append("... and {} more".format(len(self.importer.errors) - self.MAX_ERRORS))
+            raise forms.ValidationError(errors)
+        return cleaned_data
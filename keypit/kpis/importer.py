@@ -0,0 +1,231 @@
+from django.conf import settings
+from django.db import transaction
+
+from datetime import datetime
+import csv
+import io
+import json
+
+from . import caching
+from .models import KPI, KPIEntry, KPIRollup, Unit, UnitClosure, refresh_unit_entries
+
+IMPORT_BATCH_SIZE = getattr(settings, 'IMPORT_BATCH_SIZE', 1000)
+IMPORT_DELTA_LIMIT = getattr(settings, 'IMPORT_DELTA_LIMIT', 100)
+IMPORT_FORMATS = ['csv', 'json']
+
+
+def read_rows(data, fmt='csv'):
+    """
+    Parse uploaded CSV or JSON (a list of objects) into a list of dictionaries with the keys unit, kpi, month,
+    value and comments. The CSV produced by the entry export can be imported as is.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8-sig')
+    if fmt == 'json':
+        rows = json.loads(data)
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError('JSON imports must be a list of objects')
+        return rows
+    return list(csv.DictReader(io.StringIO(data)))
+
+
+def parse_month(value):
+    value = '{}'.format(value or '').strip()
+    for fmt in ['%Y-%m', '%Y-%m-%d']:
+        try:
+            return datetime.strptime(value, fmt).date().replace(day=1)
+        except ValueError:
+            pass
+    raise ValueError('Invalid month "{}", expected YYYY-MM'.format(value))
+
+
+def parse_value(value):
+    if value is None or '{}'.format(value).strip() == '':
+        return None
+    try:
+        return int('{}'.format(value).strip())
+    except ValueError:
+        raise ValueError('Invalid value "{}", expected a whole number'.format(value))
+
+
+class EntryImport(object):
+    """
+    Validates rows of (unit acronym or id, kpi name or id, month, value, comments) against lookup tables loaded
+    up front and writes them in a single transaction. If unit is given, only rows for that unit are accepted
+    and the unit may be omitted from the rows. A row without a value or comments field keeps the stored
+    value or comments of an existing entry.
+
+    After validate(), errors holds a (line, message) pair for every invalid row and changes holds a
+    (line, action, entry, previous) tuple for every valid row, where action is one of 'create', 'update'
+    or 'unchanged' and previous is the (value, comments) of the existing entry.
+    """
+
+    def __init__(self, rows, unit=None):
+        self.rows = rows
+        self.unit = unit
+        self.errors = []
+        self.changes = []
+
+    def lookups(self):
+        units = Unit.tree.filter(pk=self.unit.pk) if self.unit else Unit.tree.all()
+        self.units = {}
+        self.unit_acronyms = {}
+        for unit in units:
+            self.units[unit.pk] = unit
+            self.unit_acronyms.setdefault(unit.acronym, []).append(unit)
+        self.kpis = {}
+        self.kpi_names = {}
+        for kpi in KPI.objects.all():
+            self.kpis[kpi.pk] = kpi
+            self.kpi_names.setdefault(kpi.name, []).append(kpi)
+        # a KPI applies to the units it is assigned to and to their descendants, as in Unit.indicators()
+        links = UnitClosure.objects.filter(ancestor__kpi__isnull=False).exclude(
+            ancestor__parent__isnull=True, depth__gte=1)
+        if self.unit:
+            links = links.filter(descendant=self.unit)
+        self.applicable = set(links.values_list('descendant', 'ancestor__kpi'))
+
+    def resolve_kpi(self, value):
+        if isinstance(value, int) and not isinstance(value, bool):
+            if value in self.kpis:
+                return self.kpis[value]
+            raise ValueError('Unknown KPI {}'.format(value))
+        value = '{}'.format(value or '').strip()
+        kpis = self.kpi_names.get(value, [])
+        if len(kpis) > 1:
+            raise ValueError('KPI name "{}" is ambiguous, use the KPI id'.format(value))
+        elif kpis:
+            return kpis[0]
+        elif value.isdigit() and int(value) in self.kpis:
+            return self.kpis[int(value)]
+        raise ValueError('Unknown KPI "{}"'.format(value))
+
+    def resolve_unit(self, value):
+        if self.unit and not value:
+            return self.unit
+        if isinstance(value, int) and not isinstance(value, bool):
+            if value in self.units:
+                return self.units[value]
+            raise ValueError('Unknown unit {}'.format(value))
+        value = '{}'.format(value or '').strip()
+        units = self.unit_acronyms.get(value, [])
+        if len(units) > 1:
+            raise ValueError('Unit acronym "{}" is ambiguous, use the unit id'.format(value))
+        elif units:
+            return units[0]
+        elif value.isdigit() and int(value) in self.units:
+            return self.units[int(value)]
+        raise ValueError('Unknown unit "{}"'.format(value))
+
+    def validate_row(self, row):
+        unit = self.resolve_unit(row.get('unit'))
+        kpi = self.resolve_kpi(row.get('kpi'))
+        if (unit.pk, kpi.pk) not in self.applicable:
+            raise ValueError('KPI "{}" is not tracked for unit "{}"'.format(kpi, unit))
+        return KPIEntry(
+            unit=unit, kpi=kpi, month=parse_month(row.get('month')), value=parse_value(row.get('value')),
+            comments=row.get('comments') or ''
+        )
+
+    def validate(self):
+        self.lookups()
+        self.errors = []
+        self.changes = []
+        seen = {}
+        for start in range(0, len(self.rows), IMPORT_BATCH_SIZE):
+            batch = []
+            for line, row in enumerate(self.rows[start:start + IMPORT_BATCH_SIZE], start=start + 1):
+                try:
+                    entry = self.validate_row(row)
+                except ValueError as e:
+                    self.errors.append((line, '{}'.format(e)))
+                    continue
+                key = (entry.unit.pk, entry.kpi.pk, entry.month)
+                if key in seen:
+                    self.errors.append((line, 'Duplicate of line {}'.format(seen[key])))
+                    continue
+                seen[key] = line
+                batch.append((line, row, entry))
+
+            existing = {
+                (unit, kpi, month): (value, comments)
+                for unit, kpi, month, value, comments in KPIEntry.objects.filter(
+                    unit__in={entry.unit.pk for line, row, entry in batch},
+                    kpi__in={entry.kpi.pk for line, row, entry in batch},
+                    month__in={entry.month for line, row, entry in batch},
+                ).values_list('unit', 'kpi', 'month', 'value', 'comments')
+            }
+            for line, row, entry in batch:
+                previous = existing.get((entry.unit.pk, entry.kpi.pk, entry.month))
+                if previous is not None:
+                    entry.value = previous[0] if 'value' not in row else entry.value
+                    entry.comments = previous[1] if 'comments' not in row else entry.comments
+                if previous is None:
+                    action = 'create'
+                elif (previous[0], previous[1] or '') != (entry.value, entry.comments or ''):
+                    action = 'update'
+                else:
+                    action = 'unchanged'
+                self.changes.append((line, action, entry, previous))
+        return not self.errors
+
+    def summary(self):
+        actions = [action for line, action, entry, previous in self.changes]
+        return {
+            'rows': len(self.rows),
+            'errors': [{'line': line, 'error': error} for line, error in self.errors],
+            'created': actions.count('create'),
+            'updated': actions.count('update'),
+            'unchanged': actions.count('unchanged'),
+            'changes': [
+                {
+                    'line': line, 'action': action, 'unit': entry.unit.acronym, 'kpi': entry.kpi.name,
+                    'month': entry.month.strftime('%Y-%m'), 'value': entry.value,
+                    'previous': previous and previous[0],
+                } for line, action, entry, previous in self.changes if action != 'unchanged'
+            ],
+        }
+
+    def save(self):
+        """
+        Create or update all changed entries in one transaction. Nothing is written if any row is invalid.
+        Up to IMPORT_DELTA_LIMIT changes, e.g. edits from the entry grid, adjust the rollups of each changed
+        entry, larger imports recompute the affected rollups.
+        """
+        if self.errors:
+            return 0
+        entries = [entry for line, action, entry, previous in self.changes if action != 'unchanged']
+        if not entries:
+            return 0
+        deltas = len(entries) <= IMPORT_DELTA_LIMIT
+        with transaction.atomic():
+            if deltas:
+                # the values being replaced, locked until their rollups have been adjusted
+                locked = KPIEntry.objects.select_for_update().filter(
+                    unit__in={entry.unit.pk for entry in entries}, kpi__in={entry.kpi.pk for entry in entries},
+                    month__in={entry.month for entry in entries},
+                )
+                current = {
+                    (unit, kpi, month): value
+                    for unit, kpi, month, value in locked.values_list('unit', 'kpi', 'month', 'value')
+                }
+            KPIEntry.objects.bulk_create(
+                entries, update_conflicts=True, unique_fields=['kpi', 'unit', 'month'],
+                update_fields=['value', 'comments'], batch_size=IMPORT_BATCH_SIZE
+            )
+            if not deltas:
+                refresh_unit_entries(entries)
+                return len(entries)
+
+            ancestors = {}
+            for ancestor, unit in UnitClosure.objects.filter(
+                    descendant__in={entry.unit.pk for entry in entries}).values_list('ancestor', 'descendant'):
+                ancestors.setdefault(unit, []).append(ancestor)
+            for entry in entries:
+                key = (entry.unit.pk, entry.kpi.pk, entry.month)
+                if key not in current:
+                    KPIRollup.apply(*key, entry.value, ancestors=ancestors[entry.unit.pk])
+                elif current[key] != entry.value:
+                    KPIRollup.replace(*key, current[key], entry.value, ancestors=ancestors[entry.unit.pk])
+            caching.invalidate_reports()
+        return len(entries)
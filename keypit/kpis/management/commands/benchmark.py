@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from keypit.kpis import benchmark
+
+
+class Command(BaseCommand):
+    help = """Benchmarks the report functions and pages on synthetic data in a temporary test database
+                - reports the queries, time (ms) and peak memory (KB) of each scenario
+                - fails if a scenario exceeds or has no baseline, provide --save to record new baselines
+                - needs PostgreSQL, like the migrations"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--depth', type=int, default=3)
+        parser.add_argument('--width', type=int, default=3)
+        parser.add_argument('--kpis', type=int, default=12)
+        parser.add_argument('--categories', type=int, default=3)
+        parser.add_argument('--families', type=int, default=2)
+        parser.add_argument('--years', type=int, default=2)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--tolerance', type=float, default=benchmark.BENCHMARK_TOLERANCE)
+        parser.add_argument('--baselines', type=str, default=benchmark.BENCHMARK_BASELINES)
+        parser.add_argument('--save', action='store_true')
+
+    def handle(self, *args, **options):
+        if options['depth'] < 1 or options['width'] < 1:
+            raise CommandError("--depth and --width must be at least 1")
+        if connection.vendor != 'postgresql':
+            # Unit.admin_roles is an ArrayField, so the migrations and the synthetic data need PostgreSQL
+            raise CommandError("Benchmarks can only run on PostgreSQL, not {}".format(connection.vendor))
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            data = benchmark.generate(
+                depth=options['depth'], width=options['width'], kpis=options['kpis'],
+                categories=options['categories'], families=options['families'], years=options['years'],
+            )
+            results = benchmark.run(data, repeat=options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        baselines = benchmark.load_baselines(options['baselines'])
+        self.stdout.write("{:<20} {:>8} {:>10} {:>10}".format('Scenario', 'Queries', 'Time', 'Memory'))
+        for name, result in results.items():
+            self.stdout.write("{:<20} {queries:>8} {time:>8}ms {memory:>8}KB".format(name, **result))
+
+        if options['save']:
+            benchmark.save_baselines(results, options['baselines'])
+            self.stdout.write("Baselines for {} saved to {}".format(connection.vendor, options['baselines']))
+            return
+        failures = benchmark.compare(results, baselines, tolerance=options['tolerance'])
+        if failures:
+            raise CommandError("Benchmarks failed against their baselines:\n  {}".format("\n  ".join(failures)))
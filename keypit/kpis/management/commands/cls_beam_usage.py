@@ -1,14 +1,19 @@
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 from django.utils import timezone
 
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import pytz
 import requests
 
-from keypit.kpis.models import Unit, KPI, KPIEntry
+from keypit.kpis.client import get_client
+from keypit.kpis.models import Unit, KPI, KPIEntry, refresh_unit_entries
 
 USO_API = getattr(settings, 'USO_API', 'https://user.lightsource.ca/api/v1/')
+USO_WORKERS = getattr(settings, 'USO_WORKERS', 8)
 
 BEAMLINE_AVAILABILITY = 7
 TOTAL_NORMAL_SHIFTS = 8
@@ -19,64 +24,115 @@ def format_localtime(dt):
     #return datetime.strftime(timezone.localtime(pytz.utc.localize(dt)), '%Y-%m-%dT%H')
 
 
+def next_month(dt):
+    return dt.replace(year=dt.month == 12 and dt.year + 1 or dt.year, month=dt.month == 12 and 1 or dt.month + 1)
+
+
+def month_starts(first, last):
+    """
+    Aware local datetimes for the first day of every month from first to last, inclusive
+    """
+    months = []
+    dt = first.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    while dt <= last:
+        months.append(timezone.make_aware(dt))
+        dt = next_month(dt)
+    return months
+
+
+def monthly_shifts(items, months, end):
+    """
+    Bucket the 8-hour shifts covered by USO schedule items into a set of formatted shift starts per month
+    """
+    shifts = {month: set() for month in months}
+    for item in items:
+        st = pytz.utc.localize(datetime.strptime(item['start'], '%Y-%m-%dT%H:%M:%SZ'))
+        ed = pytz.utc.localize(datetime.strptime(item['end'], '%Y-%m-%dT%H:%M:%SZ'))
+        while st < ed:
+            if months[0] <= st < end:
+                shifts[months[bisect_right(months, st) - 1]].add(format_localtime(st))
+            st += timedelta(hours=8)
+    return shifts
+
+
 class Command(BaseCommand):
     help = """Fetches Publications and Scheduling KPIs information from the CLS USO
-                - provide an optional --date in the format yyyy-mm-dd"""
+                - provide an optional --date in the format yyyy-mm-dd
+                - or a range of months with --start and --end in the format yyyy-mm"""
 
     def add_arguments(self, parser):
         parser.add_argument('--date', type=str)
         parser.add_argument('--month', type=int)
         parser.add_argument('--year', type=int)
+        parser.add_argument('--start', type=str)
+        parser.add_argument('--end', type=str)
+
+    def fetch(self, url):
+        try:
+            r = get_client().get(url)
+        except requests.RequestException:
+            return None
+        return r.json() if r.status_code == 200 else None
 
     def handle(self, *args, **options):
-        if options.get('date'):
-            dt = datetime.strptime(options.get('date'), '%Y-%m-%d')
-        elif options.get('year'):
-            dt = datetime(options.get('year'), options.get('month', 1), 1)
+        if options.get('start'):
+            first = datetime.strptime(options.get('start'), '%Y-%m')
+            last = options.get('end') and datetime.strptime(options.get('end'), '%Y-%m') or first
         else:
-            dt = datetime.now().replace(day=1) - timedelta(days=1)
-        start = timezone.make_aware(dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0))
-        end = timezone.make_aware(datetime(dt.month == 12 and dt.year + 1 or dt.year, dt.month == 12 and 1 or dt.month + 1, 1))
-        qstart = datetime.strftime(start, '%Y-%m-%d')
+            if options.get('date'):
+                dt = datetime.strptime(options.get('date'), '%Y-%m-%d')
+            elif options.get('year'):
+                dt = datetime(options.get('year'), options.get('month') or 1, 1)
+            else:
+                dt = datetime.now().replace(day=1) - timedelta(days=1)
+            first = last = dt
+        months = month_starts(first, last)
+        if not months:
+            raise CommandError("--end must not be earlier than --start")
+        end = next_month(months[-1])
+        qstart = datetime.strftime(months[0], '%Y-%m-%d')
         qend = datetime.strftime(end, '%Y-%m-%d')
 
+        kpis = KPI.objects.in_bulk([TOTAL_NORMAL_SHIFTS, TOTAL_SHIFTS_USED])
+        if len(kpis) != 2:
+            raise CommandError("Scheduling KPIs {} and {} must exist".format(TOTAL_NORMAL_SHIFTS, TOTAL_SHIFTS_USED))
+
+        units = list(Unit.tree.filter(kind__name="Beamline"))
+        acronyms = sorted({acronym for unit in units for acronym in unit.beamline_acronyms()})
+
         # Import Modes
-        n_shifts = []
-        url = "{}schedule/modes/?start={}&end={}".format(USO_API, qstart, qend)
-        r = requests.get(url)
-        if r.status_code == 200:
-            modes = [s for s in r.json() if s['kind'] == 'N' and not s['cancelled']]
-            for mode in modes:
-                st = pytz.utc.localize(datetime.strptime(mode['start'], '%Y-%m-%dT%H:%M:%SZ'))
-                ed = pytz.utc.localize(datetime.strptime(mode['end'], '%Y-%m-%dT%H:%M:%SZ'))
-                while st < ed:
-                    if st >= start and st < end: n_shifts.append(format_localtime(st))
-                    st += timedelta(hours=8)
-        n_shifts = set(n_shifts)
-
-        for unit in Unit.tree.filter(kind__name="Beamline"):
-            bl_n_shifts = 0
-            bl_used_shifts = 0
-            for acronym in unit.beamline_acronyms():
-                # Import Facility Schedule(s)
-                url = "{}schedule/beamtime/{}/?start={}&end={}".format(USO_API, acronym, qstart, qend)
-                r = requests.get(url)
-                if r.status_code == 200:
-                    visits = [s for s in r.json() if not s['cancelled']]
-                    shifts = []
-                    for visit in visits:
-                        st = pytz.utc.localize(datetime.strptime(visit['start'], '%Y-%m-%dT%H:%M:%SZ'))
-                        ed = pytz.utc.localize(datetime.strptime(visit['end'], '%Y-%m-%dT%H:%M:%SZ'))
-                        while st < ed:
-                            if st >= start and st < end: shifts.append(format_localtime(st))
-                            st += timedelta(hours=8)
-                else:
-                    shifts = []
-                    print("Schedule not found for {}".format(acronym))
-                bl_n_shifts += len(n_shifts)
-                bl_used_shifts += len(n_shifts.intersection(set(shifts)))
-
-            KPIEntry.objects.update_or_create(unit=unit, month=start, kpi=KPI.objects.get(pk=TOTAL_NORMAL_SHIFTS),
-                                              defaults={'value': bl_n_shifts})
-            KPIEntry.objects.update_or_create(unit=unit, month=start.date(), kpi=KPI.objects.get(pk=TOTAL_SHIFTS_USED),
-                                              defaults={'value': bl_used_shifts})
+        modes = self.fetch("{}schedule/modes/?start={}&end={}".format(USO_API, qstart, qend)) or []
+        n_shifts = monthly_shifts(
+            [s for s in modes if s['kind'] == 'N' and not s['cancelled']], months, end
+        )
+
+        # Import Facility Schedule(s)
+        urls = ["{}schedule/beamtime/{}/?start={}&end={}".format(USO_API, acronym, qstart, qend)
+                for acronym in acronyms]
+        with ThreadPoolExecutor(max_workers=USO_WORKERS) as pool:
+            schedules = dict(zip(acronyms, pool.map(self.fetch, urls)))
+
+        shifts = {}
+        for acronym, visits in schedules.items():
+            if visits is None:
+                print("Schedule not found for {}".format(acronym))
+            shifts[acronym] = monthly_shifts([s for s in visits or [] if not s['cancelled']], months, end)
+
+        entries = []
+        for unit in units:
+            for month in months:
+                bl_n_shifts = 0
+                bl_used_shifts = 0
+                for acronym in unit.beamline_acronyms():
+                    bl_n_shifts += len(n_shifts[month])
+                    bl_used_shifts += len(n_shifts[month].intersection(shifts[acronym][month]))
+                entries += [
+                    KPIEntry(unit=unit, month=month.date(), kpi_id=TOTAL_NORMAL_SHIFTS, value=bl_n_shifts),
+                    KPIEntry(unit=unit, month=month.date(), kpi_id=TOTAL_SHIFTS_USED, value=bl_used_shifts),
+                ]
+
+        with transaction.atomic():
+            KPIEntry.objects.bulk_create(
+                entries, update_conflicts=True, unique_fields=['kpi', 'unit', 'month'], update_fields=['value']
+            )
+            refresh_unit_entries(entries)
@@ -1,13 +1,18 @@
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import transaction
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import hashlib
 import re
 import requests
 
-from keypit.kpis.models import KPI, KPIEntry
+from keypit.kpis.client import get_client
+from keypit.kpis.models import KPI, KPIEntry, PublicationCheckpoint, refresh_unit_entries
 
 USO_API = getattr(settings, 'USO_API', 'https://user.lightsource.ca/api/v1/')
+USO_WORKERS = getattr(settings, 'USO_WORKERS', 8)
 PUBLICATION_KPIS = getattr(settings, 'PUBLICATION_KPIS', {
     5: ['article'],
     14: ['msc_thesis', 'phd_thesis'],
@@ -15,41 +20,111 @@ PUBLICATION_KPIS = getattr(settings, 'PUBLICATION_KPIS', {
 })
 
 
+def month_key(dt):
+    return datetime.strftime(dt, '%Y-%m')
+
+
+def digest(value, comments):
+    return hashlib.sha1('{}|{}'.format(value, comments).encode('utf-8')).hexdigest()
+
+
 class Command(BaseCommand):
-    help = """Fetches Publications from the CLS USO"""
+    help = """Fetches Publications from the CLS USO
+                - only months whose citations changed since the last run are written,
+                  provide --full to rewrite every month"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true')
+
+    def fetch(self, url):
+        """
+        The publications at url, or None if they could not be fetched
+        """
+        try:
+            r = get_client().get(url)
+        except requests.RequestException:
+            return None
+        return r.json() if r.status_code == 200 else None
 
     def handle(self, *args, **options):
+        full = options.get('full')
+        kpis = KPI.objects.in_bulk(list(PUBLICATION_KPIS.keys()))
+        targets = {
+            pk: [unit for unit in kpis[pk].reporting_units() if unit.reporter()] for pk in PUBLICATION_KPIS if pk in kpis
+        }
+
+        # Each (kind, acronym) is requested once, even if several KPIs or units share it
+        urls = sorted({
+            "{api}publications/{kind}/{acronym}/".format(api=USO_API, kind=kind, acronym=acronym)
+            for pk, units in targets.items() for unit in units
+            for acronym in unit.beamline_acronyms() for kind in PUBLICATION_KPIS[pk]
+        })
+        with ThreadPoolExecutor(max_workers=USO_WORKERS) as pool:
+            responses = dict(zip(urls, pool.map(self.fetch, urls)))
+
+        checkpoints = {
+            (cp.kpi_id, cp.unit_id): cp for cp in PublicationCheckpoint.objects.filter(kpi__in=targets.keys())
+        }
+        this_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        changed = []
+
+        for pk, units in targets.items():
+            entries = []
+            updated = []
+            skipped = []
+            for unit in units:
+                unit_urls = [
+                    "{api}publications/{kind}/{acronym}/".format(api=USO_API, kind=kind, acronym=acronym)
+                    for acronym in unit.beamline_acronyms() for kind in PUBLICATION_KPIS[pk]
+                ]
+                # A failed request is not the same as no publications, keep the stored months of the unit
+                if any(responses[url] is None for url in unit_urls):
+                    skipped.append(unit)
+                    continue
+
+                # Import Facility Publications
+                publications = {}
+                for url in unit_urls:
+                    dates = [(datetime(*[int(i) for i in re.split('\-+', s['date'])][:-1], 1), s['cite'])
+                             for s in responses[url]]
+                    for d, c in dates:
+                        publications.setdefault(d, set()).add(c)
+
+                first_month = publications and min(publications.keys()) or this_month
+                months = set(publications.keys())
+                while first_month <= this_month:
+                    months.add(first_month)
+                    first_month = datetime(first_month.month == 12 and first_month.year + 1 or first_month.year,
+                                           first_month.month == 12 and 1 or first_month.month + 1, 1)
+
+                checkpoint = checkpoints.get((pk, unit.pk)) or PublicationCheckpoint(kpi_id=pk, unit=unit)
+                digests = {}
+                for dt in sorted(months):
+                    citations = sorted(publications.get(dt, []))
+                    comments = citations and '<ul>{}</ul>'.format(''.join(['<li>{}</li>'.format(c) for c in citations])) or ''
+                    digests[month_key(dt)] = digest(len(citations), comments)
+                    if full or checkpoint.digests.get(month_key(dt)) != digests[month_key(dt)]:
+                        entries.append(KPIEntry(unit=unit, month=dt.date(), kpi_id=pk, value=len(citations), comments=comments))
+
+                if full or digests != checkpoint.digests:
+                    checkpoint.digests = digests
+                    updated.append(checkpoint)
 
-        for pk, keys in PUBLICATION_KPIS.items():
-            kpi = KPI.objects.get(pk=pk)
-            for unit in kpi.reporting_units():
-                if unit.reporter():
-                    publications = {}
-                    for acronym in unit.beamline_acronyms():
-                        # Import Facility Publications
-                        for kind in keys:
-                            url = "{api}publications/{kind}/{acronym}/".format(api=USO_API, kind=kind, acronym=acronym)
-                            r = requests.get(url)
-                            if r.status_code == 200:
-                                dates = [(datetime(*[int(i) for i in re.split('\-+', s['date'])][:-1], 1), s['cite'])
-                                         for s in r.json()]
-                                for d, c in dates:
-                                    publications.setdefault(d, []).append(c)
-
-                    this_month = datetime.now().replace(day=1)
-                    first_month = publications and min(publications.keys()) or this_month
-
-                    for dt, citations in publications.items():
-                        citations = set(citations)
-                        if dt >= first_month:
-                            comments = '<ul>{}</ul>'.format(''.join(['<li>{}</li>'.format(c) for c in citations]))
-                            KPIEntry.objects.update_or_create(unit=unit, month=dt, kpi=kpi,
-                                                              defaults={'value': len(citations), 'comments': comments})
-
-                    while first_month <= this_month:
-                        if first_month not in publications:
-                            KPIEntry.objects.update_or_create(unit=unit, month=first_month, kpi=kpi,
-                                                              defaults={'value': 0, 'comments': ''})
-                        first_month = datetime(first_month.month == 12 and first_month.year + 1 or first_month.year,
-                                               first_month.month == 12 and 1 or first_month.month + 1, 1)
+            with transaction.atomic():
+                KPIEntry.objects.bulk_create(
+                    entries, update_conflicts=True, unique_fields=['kpi', 'unit', 'month'],
+                    update_fields=['value', 'comments'], batch_size=1000
+                )
+                PublicationCheckpoint.objects.bulk_create(
+                    updated, update_conflicts=True, unique_fields=['kpi', 'unit'],
+                    update_fields=['digests']
+                )
+            changed += entries
+            self.stdout.write("{}: {} months updated for {} units".format(kpis[pk], len(entries), len(updated)))
+            if skipped:
+                self.stderr.write("{}: skipped {}, their publications could not be fetched".format(
+                    kpis[pk], ', '.join(unit.acronym for unit in skipped)
+                ))
 
+        if changed:
+            refresh_unit_entries(changed)
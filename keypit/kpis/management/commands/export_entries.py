@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import sys
+
+from keypit.kpis import export
+from keypit.kpis.models import Unit
+
+
+class Command(BaseCommand):
+    help = """Exports KPI entries as CSV, XLSX or Parquet
+                - provide an optional --unit acronym to export the unit and its descendants
+                - and optional --kpi and --category ids, and --start and --end months in the format yyyy-mm"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--unit', type=str)
+        parser.add_argument('--kpi', type=int)
+        parser.add_argument('--category', type=int)
+        parser.add_argument('--start', type=str)
+        parser.add_argument('--end', type=str)
+        parser.add_argument('--format', type=str, default='csv', choices=list(export.WRITERS.keys()))
+        parser.add_argument('--output', type=str, help="Output file, CSV is written to stdout if omitted")
+
+    def handle(self, *args, **options):
+        fmt = options.get('format')
+        if fmt not in export.export_formats():
+            raise CommandError("The {} export format is not available, install the optional library it needs".format(fmt))
+        if fmt != 'csv' and not options.get('output'):
+            raise CommandError("--output is required for the {} format".format(fmt))
+
+        unit = None
+        if options.get('unit'):
+            unit = Unit.tree.filter(acronym=options.get('unit')).first()
+            if not unit:
+                raise CommandError("Unit {} does not exist".format(options.get('unit')))
+        try:
+            rows = export.export_rows(
+                unit=unit, kpi=options.get('kpi'), category=options.get('category'),
+                start=export.parse_month(options.get('start')), end=export.parse_month(options.get('end')),
+            )
+        except ValueError:
+            raise CommandError("Months must be given in the format yyyy-mm")
+
+        if options.get('output'):
+            with open(options.get('output'), 'wb') as stream:
+                export.WRITERS[fmt](rows, stream)
+        else:
+            export.write_csv(rows, sys.stdout.buffer)
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from keypit.kpis.importer import EntryImport, IMPORT_FORMATS, read_rows
+
+
+class Command(BaseCommand):
+    help = """Imports KPI entries from CSV or JSON with the columns unit (acronym or id), kpi (name or id),
+                month (yyyy-mm), value and comments. Existing entries are updated.
+                - nothing is written if any row is invalid
+                - provide --dry-run to only report the changes"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', type=str)
+        parser.add_argument('--format', type=str, choices=IMPORT_FORMATS)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        path = options.get('file')
+        fmt = options.get('format') or path.rsplit('.', 1)[-1].lower()
+        if fmt not in IMPORT_FORMATS:
+            raise CommandError("Unable to determine the format of {}, provide --format".format(path))
+        try:
+            with open(path, 'rb') as f:
+                importer = EntryImport(read_rows(f.read(), fmt))
+        except (OSError, ValueError) as e:
+            raise CommandError("Unable to read {}: {}".format(path, e))
+
+        importer.validate()
+        summary = importer.summary()
+        for change in summary['changes']:
+            self.stdout.write("Line {line}: {action} {unit} {kpi} {month}: {previous} -> {value}".format(**change))
+        for error in summary['errors']:
+            self.stderr.write("Line {line}: {error}".format(**error))
+        self.stdout.write("{rows} rows: {created} to create, {updated} to update, {unchanged} unchanged".format(**summary))
+        if importer.errors:
+            raise CommandError("{} invalid rows, nothing was imported".format(len(importer.errors)))
+        if not options.get('dry_run'):
+            self.stdout.write("{} entries saved".format(importer.save()))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from keypit.kpis.models import KPIRollup
+
+FIELDS = ['value_sum', 'entry_count', 'value_count']
+
+
+class Command(BaseCommand):
+    help = """Rebuilds the monthly KPI rollups of every unit from the KPI entries of its subtree
+                - provide --check to only verify the rollups against a raw aggregation of the entries"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true')
+
+    def handle(self, *args, **options):
+        if options.get('check'):
+            expected = {
+                (row['rollup_unit'], row['kpi'], row['month']): tuple(row[f] for f in FIELDS)
+                for row in KPIRollup.aggregate()
+            }
+            existing = {
+                (row['unit'], row['kpi'], row['month']): tuple(row[f] for f in FIELDS)
+                for row in KPIRollup.objects.values('unit', 'kpi', 'month', *FIELDS)
+            }
+            mismatched = sorted(k for k in set(expected) | set(existing) if expected.get(k) != existing.get(k))
+            for key in mismatched:
+                self.stdout.write("Unit {} KPI {} {}: expected {}, found {}".format(
+                    *key, expected.get(key), existing.get(key)))
+            if mismatched:
+                raise CommandError("{} KPI rollups are inconsistent, run kpi_rollup without --check to rebuild them".format(
+                    len(mismatched)))
+            self.stdout.write("KPI rollups are consistent ({} rollups)".format(len(existing)))
+        else:
+            count = KPIRollup.refresh()
+            self.stdout.write("KPI rollups rebuilt ({} rollups)".format(count))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from keypit.kpis.models import UnitClosure
+
+
+class Command(BaseCommand):
+    help = """Rebuilds the Unit ancestor/descendant closure table from the unit parents
+                - provide --check to only verify that the table is consistent"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true')
+
+    def handle(self, *args, **options):
+        if options.get('check'):
+            expected = UnitClosure.expected()
+            existing = set(UnitClosure.objects.values_list('ancestor', 'descendant', 'depth'))
+            for link in sorted(expected - existing):
+                self.stdout.write("Missing link: {} > {} ({})".format(*link))
+            for link in sorted(existing - expected):
+                self.stdout.write("Stale link: {} > {} ({})".format(*link))
+            if expected != existing:
+                raise CommandError("Unit closure table is inconsistent, run unit_tree without --check to rebuild it")
+            self.stdout.write("Unit closure table is consistent ({} links)".format(len(existing)))
+        else:
+            count = UnitClosure.rebuild()
+            self.stdout.write("Unit closure table rebuilt ({} links)".format(count))
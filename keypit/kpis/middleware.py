@@ -0,0 +1,161 @@
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from collections import deque
+from logging.handlers import RotatingFileHandler
+import heapq
+import json
+import math
+import os
+import random
+import threading
+import time
+
+import logging
+
+PERF_ENABLED = getattr(settings, 'PERF_ENABLED', True)
+PERF_LOG = getattr(settings, 'PERF_LOG', os.path.join(settings.LOCAL_DIR, 'logs', 'requests.log'))
+PERF_LOG_SIZE = getattr(settings, 'PERF_LOG_SIZE', 10 * 1024 * 1024)
+PERF_LOG_BACKUPS = getattr(settings, 'PERF_LOG_BACKUPS', 5)
+PERF_SAMPLE_RATE = getattr(settings, 'PERF_SAMPLE_RATE', 1.0)
+PERF_SLOW_THRESHOLD = getattr(settings, 'PERF_SLOW_THRESHOLD', 1000)   # milliseconds
+PERF_SLOW_QUERIES = getattr(settings, 'PERF_SLOW_QUERIES', 5)
+PERF_STATS_LINES = getattr(settings, 'PERF_STATS_LINES', 10000)
+
+_logger = None
+_logger_lock = threading.Lock()
+
+
+def get_logger():
+    """
+    Logger writing one JSON document per line to the rotating PERF_LOG file
+    """
+    global _logger
+    with _logger_lock:
+        if _logger is None:
+            os.makedirs(os.path.dirname(PERF_LOG), exist_ok=True)
+            handler = RotatingFileHandler(PERF_LOG, maxBytes=PERF_LOG_SIZE, backupCount=PERF_LOG_BACKUPS)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            _logger = logging.getLogger('keypit.performance')
+            _logger.addHandler(handler)
+            _logger.setLevel(logging.INFO)
+            _logger.propagate = False
+    return _logger
+
+
+class RequestTimer(object):
+    """
+    Database execute wrapper counting and timing the queries of a request, keeping the slowest ones
+    """
+
+    def __init__(self, keep=PERF_SLOW_QUERIES):
+        self.keep = keep
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest = []
+        self.template_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.queries += 1
+            self.db_time += elapsed
+            if self.keep:
+                item = (elapsed, self.queries, sql)
+                if len(self.slowest) < self.keep:
+                    heapq.heappush(self.slowest, item)
+                else:
+                    heapq.heappushpop(self.slowest, item)
+
+
+class PerformanceMiddleware(object):
+    """
+    Record the view, query count, database time, template render time and total time of a sample of
+    requests (PERF_SAMPLE_RATE) in the PERF_LOG file. Requests slower than PERF_SLOW_THRESHOLD milliseconds
+    also record their PERF_SLOW_QUERIES slowest SQL statements. Requests which are not sampled are passed
+    through untouched.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not PERF_ENABLED or random.random() >= PERF_SAMPLE_RATE:
+            return self.get_response(request)
+
+        timer = request.perf_timer = RequestTimer()
+        start = time.perf_counter()
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+        total = (time.perf_counter() - start) * 1000
+
+        record = {
+            'time': timezone.now().isoformat(),
+            'method': request.method,
+            'path': request.path,
+            'view': request.resolver_match and request.resolver_match.view_name or None,
+            'status': response.status_code,
+            'queries': timer.queries,
+            'db_ms': round(timer.db_time * 1000, 2),
+            'template_ms': round(timer.template_time * 1000, 2),
+            'total_ms': round(total, 2),
+            'slow': total > PERF_SLOW_THRESHOLD,
+        }
+        if record['slow']:
+            record['slow_queries'] = [
+                {'ms': round(elapsed * 1000, 2), 'sql': sql} for elapsed, i, sql in sorted(timer.slowest, reverse=True)
+            ]
+        get_logger().info(json.dumps(record))
+        return response
+
+    def process_template_response(self, request, response):
+        timer = getattr(request, 'perf_timer', None)
+        if timer:
+            start = time.perf_counter()
+
+            def rendered(response):
+                timer.template_time += time.perf_counter() - start
+            response.add_post_render_callback(rendered)
+        return response
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a sorted list of values
+    """
+    if not values:
+        return None
+    return values[max(math.ceil(pct / 100.0 * len(values)) - 1, 0)]
+
+
+def request_stats(path=PERF_LOG, lines=PERF_STATS_LINES):
+    """
+    Percentiles of the total time, database time and query counts of each view, over the last lines
+    requests in the log file
+    """
+    try:
+        with open(path) as f:
+            records = deque(f, maxlen=lines)
+    except OSError:
+        records = []
+
+    views = {}
+    for line in records:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        views.setdefault(record.get('view') or record.get('path'), []).append(record)
+
+    stats = {}
+    for view, requests in sorted(views.items()):
+        stats[view] = {'requests': len(requests), 'slow': sum(1 for r in requests if r.get('slow'))}
+        for key in ['total_ms', 'db_ms', 'template_ms', 'queries']:
+            values = sorted(r.get(key, 0) for r in requests)
+            stats[view][key] = {'p{}'.format(p): percentile(values, p) for p in [50, 90, 99]}
+            stats[view][key]['max'] = values[-1]
+    return stats
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.5 on 2026-10-17 17:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_closure(apps, schema_editor):
+    Unit = apps.get_model('kpis', 'Unit')
+    UnitClosure = apps.get_model('kpis', 'UnitClosure')
+    parents = dict(Unit._default_manager.values_list('pk', 'parent'))
+    links = []
+    for pk in parents:
+        node, depth, seen = pk, 0, set()
+        while node is not None and node not in seen:
+            seen.add(node)
+            links.append(UnitClosure(ancestor_id=node, descendant_id=pk, depth=depth))
+            node, depth = parents.get(node), depth + 1
+    UnitClosure.objects.bulk_create(links, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpis', '0032_kpifamily'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnitClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='kpis.unit')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='kpis.unit')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['descendant', 'depth'], name='kpis_unitcl_descend_1fad9a_idx')],
+                'unique_together': {('ancestor', 'descendant')},
+            },
+        ),
+        migrations.RunPython(build_closure, migrations.RunPython.noop),
+    ]
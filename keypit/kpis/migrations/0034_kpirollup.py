@@ -0,0 +1,46 @@
+# Generated by Django 4.2.5 on 2026-10-17 17:40
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def build_rollups(apps, schema_editor):
+    KPIEntry = apps.get_model('kpis', 'KPIEntry')
+    KPIRollup = apps.get_model('kpis', 'KPIRollup')
+    rows = KPIEntry.objects.order_by().values(
+        'kpi', 'month', rollup_unit=models.F('unit__ancestor_links__ancestor')
+    ).annotate(
+        value_sum=Coalesce(models.Sum('value'), 0), entry_count=models.Count('pk'), value_count=models.Count('value')
+    )
+    KPIRollup.objects.bulk_create([
+        KPIRollup(unit_id=row['rollup_unit'], kpi_id=row['kpi'], month=row['month'], value_sum=row['value_sum'],
+                  entry_count=row['entry_count'], value_count=row['value_count'])
+        for row in rows
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpis', '0033_unitclosure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KPIRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('value_sum', models.BigIntegerField(default=0)),
+                ('entry_count', models.IntegerField(default=0)),
+                ('value_count', models.IntegerField(default=0)),
+                ('kpi', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='kpis.kpi')),
+                ('unit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='kpis.unit')),
+            ],
+            options={
+                'unique_together': {('unit', 'kpi', 'month')},
+            },
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.5 on 2026-10-17 18:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpis', '0034_kpirollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublicationCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digests', models.JSONField(blank=True, default=dict)),
+                ('kpi', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='kpis.kpi')),
+                ('unit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='kpis.unit')),
+            ],
+            options={
+                'unique_together': {('kpi', 'unit')},
+            },
+        ),
+    ]
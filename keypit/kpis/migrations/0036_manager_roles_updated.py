@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-17 18:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpis', '0035_publicationcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='manager',
+            name='roles_updated',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
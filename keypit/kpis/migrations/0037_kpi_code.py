@@ -0,0 +1,36 @@
+# Generated by Django 4.2.5 on 2026-10-17 18:55
+
+from django.db import migrations, models
+import string
+
+
+def set_codes(apps, schema_editor):
+    KPI = apps.get_model('kpis', 'KPI')
+    KPICategory = apps.get_model('kpis', 'KPICategory')
+    categories = {
+        pk: i + 1 for i, pk in enumerate(KPICategory.objects.order_by('priority', 'pk').values_list('pk', flat=True))
+    }
+    letters = {}
+    kpis = []
+    for kpi in KPI.objects.filter(category__isnull=False).order_by('priority', 'pk'):
+        letter = letters.setdefault(kpi.category_id, 0)
+        letters[kpi.category_id] += 1
+        kpi.code = "{}{}".format(categories[kpi.category_id], string.ascii_lowercase[letter % 26])
+        kpis.append(kpi)
+    KPI.objects.bulk_update(kpis, ['code'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpis', '0036_manager_roles_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kpi',
+            name='code',
+            field=models.CharField(blank=True, editable=False, max_length=10),
+        ),
+        migrations.RunPython(set_codes, migrations.RunPython.noop),
+    ]
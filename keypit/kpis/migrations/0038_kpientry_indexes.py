@@ -0,0 +1,29 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpis', '0037_kpi_code'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='kpientry',
+            index=models.Index(fields=['unit', 'month'], include=('kpi', 'value'), name='kpientry_unit_month_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='kpientry',
+            index=models.Index(fields=['kpi', 'month'], include=('unit', 'value'), name='kpientry_kpi_month_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='kpientry',
+            index=models.Index(condition=models.Q(('value__isnull', False)), fields=['unit', 'month'], name='kpientry_unit_month_value_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='kpientry',
+            index=models.Index(condition=models.Q(('comments__gt', '')), fields=['unit', 'month'], name='kpientry_unit_month_notes_idx'),
+        ),
+    ]
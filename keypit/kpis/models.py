@@ -1,15 +1,21 @@
-from django.db import models
+from django.db import connection, models, transaction
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.contrib.postgres.fields import ArrayField
+from django.db.models.functions import Coalesce
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import gettext as _
 
 from django_cas_ng.signals import cas_user_authenticated
 
+from keypit.kpis import caching
+from keypit.kpis.client import get_client
 from keypit.mixins.models import TreeModel
 from model_utils import Choices
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import string
 
 import logging
@@ -19,35 +25,77 @@ ADMIN_USERS = getattr(settings, 'ADMIN_USERS', [])
 ADMIN_ROLES = getattr(settings, 'ADMIN_ROLES', [])
 PEOPLE_API = getattr(settings, 'PEOPLE_API', 'https://people.lightsource.ca/api/v2/people/')
 PEOPLE_TOKEN = getattr(settings, 'PEOPLE_TOKEN', 'no token')
+PEOPLE_CACHE_TTL = getattr(settings, 'PEOPLE_CACHE_TTL', 600)
+ROLES_FRESHNESS = getattr(settings, 'ROLES_FRESHNESS', 3600)
+ROLES_WORKERS = getattr(settings, 'ROLES_WORKERS', 2)
 
 
 class Manager(AbstractUser):
     name = models.SlugField()
     user_roles = models.TextField(blank=True, null=True)
+    roles_updated = models.DateTimeField(blank=True, null=True)
 
     def roles(self):
         return self.user_roles and self.user_roles.replace('<', '').replace('>', '').split(',') or []
 
+    def roles_fresh(self):
+        return bool(self.roles_updated) and timezone.now() - self.roles_updated < timedelta(seconds=ROLES_FRESHNESS)
+
+
+def refresh_user_roleperms(username):
+    """
+    Fetch the roles of a user from the People API and update the user's roles and superuser status.
+    Only the role and permission fields are written, so concurrent changes to the user are preserved.
+    """
+    auth_header = {'Authorization': 'Bearer {token}'.format(token=PEOPLE_TOKEN)}
+    fields = {}
+    try:
+        r = get_client().get(
+            '{api}{username}/roles'.format(api=PEOPLE_API, username=username), headers=auth_header, ttl=PEOPLE_CACHE_TTL
+        )
+    except Exception:
+        logger.exception('Unable to fetch roles for {}'.format(username))
+        r = None
+    if r is not None and r.status_code == 200:
+        roles = [d.get('code') for d in r.json()]
+        logger.info('User roles: {}'.format(roles))
+        fields.update(user_roles=','.join(['{}'.format(role) for role in roles]), roles_updated=timezone.now())
+
+    user = Manager.objects.filter(username=username).first()
+    if user:
+        user.user_roles = fields.get('user_roles', user.user_roles)
+        if user.username in ADMIN_USERS or any(['{}'.format(r) in user.roles() for r in ADMIN_ROLES]):
+            logger.info('User {} is superuser'.format(user.username))
+            fields.update(is_superuser=True, is_staff=True)
+        if fields:
+            Manager.objects.filter(pk=user.pk).update(**fields)
+
+
+def refresh_user_roleperms_task(username):
+    try:
+        refresh_user_roleperms(username)
+    finally:
+        connection.close()
+
+
+_role_executor = ThreadPoolExecutor(max_workers=ROLES_WORKERS, thread_name_prefix='roles')
+
 
 @receiver(cas_user_authenticated)
 def update_user_roleperms(sender, **kwargs):
-    auth_header = {'Authorization': 'Bearer {token}'.format(token=PEOPLE_TOKEN)}
+    """
+    Refresh the roles of a user who has just logged in. Users without cached roles are refreshed before
+    the login completes, otherwise the login proceeds on the cached roles and stale roles are refreshed
+    in the background.
+    """
     user = Manager.objects.get(username=kwargs.get('username'))
     if kwargs.get('created'):
         logger.info("New account {} created".format(user.username))
 
-    r = requests.get('{api}{username}/roles'.format(api=PEOPLE_API, username=user.username), headers=auth_header)
-    if r.status_code == 200:
-        roles = [d.get('code') for d in r.json()]
-        logger.info('User roles: {}'.format(roles))
-        user.user_roles = ','.join(['{}'.format(role) for role in roles])
-        user.save()
-
-    if user.username in ADMIN_USERS or any(['{}'.format(r) in user.roles() for r in ADMIN_ROLES]):
-        logger.info('User {} is superuser'.format(user.username))
-        user.is_superuser = True
-        user.is_staff = True
-        user.save()
+    if not user.roles_updated:
+        refresh_user_roleperms(user.username)
+    elif not user.roles_fresh():
+        _role_executor.submit(refresh_user_roleperms_task, user.username)
 
 
 class UnitType(models.Model):
@@ -88,7 +136,9 @@ class Unit(TreeModel):
         return [u for u in self.descendants() if u.reporter()]
 
     def indicators(self):
-        return KPI.objects.filter(units__pk__in=[self.pk] + list([a.pk for a in self.ancestors()]))
+        # the unit itself and its ancestors, except the root, as in ancestors()
+        links = UnitClosure.objects.filter(descendant=self).exclude(depth__gte=1, ancestor__parent__isnull=True)
+        return KPI.objects.filter(units__in=links.values('ancestor'))
 
     def inherited(self):
         return self.indicators().exclude(units__pk=self.pk)
@@ -101,25 +151,113 @@ class Unit(TreeModel):
          }
 
     def ancestors(self):
-        parents = []
-        parent = self.parent
-        if parent:
-            while parent.parent:
-                parents.append(parent)
-                parent = parent.parent
-        return parents
+        return list(Unit.tree.filter(
+            descendant_links__descendant=self, descendant_links__depth__gte=1, parent__isnull=False
+        ).select_related('kind').order_by('descendant_links__depth'))
 
     def descendants(self):
-        children = list(self.children.all())
-        descendants = [i for sl in [child.children.all() for child in children] for i in sl]
-        while any(descendants):
-            for descendant in descendants:
-                children.append(descendant)
-            descendants = [i for sl in [child.children.all() for child in descendants] for i in sl]
-        return children
+        return list(Unit.tree.filter(
+            ancestor_links__ancestor=self, ancestor_links__depth__gte=1
+        ).select_related('kind').order_by('ancestor_links__depth', 'pk'))
 
     def depth(self):
-        return len(self.ancestors())
+        return max(self.ancestor_links.filter(depth__gte=1).count() - 1, 0)
+
+
+class UnitClosure(models.Model):
+    """
+    Materialized (ancestor, descendant, depth) pairs for the Unit tree, including a depth 0 link from every
+    unit to itself. Kept up to date when units are saved or deleted and rebuilt with the unit_tree command.
+    """
+    ancestor = models.ForeignKey(Unit, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Unit, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveIntegerField()
+
+    def __str__(self):
+        return "{} > {} ({})".format(self.ancestor_id, self.descendant_id, self.depth)
+
+    @classmethod
+    def expected(cls):
+        """
+        Closure links computed in memory from the parent pointers of all units, as a set of
+        (ancestor, descendant, depth) tuples
+        """
+        parents = dict(Unit.tree.values_list('pk', 'parent'))
+        links = set()
+        for pk in parents:
+            node, depth, seen = pk, 0, set()
+            while node is not None and node not in seen:
+                seen.add(node)
+                links.add((node, pk, depth))
+                node, depth = parents.get(node), depth + 1
+        return links
+
+    @classmethod
+    def rebuild(cls):
+        links = cls.expected()
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create([
+                cls(ancestor_id=a, descendant_id=d, depth=depth) for a, d, depth in links
+            ], batch_size=1000)
+        return len(links)
+
+    @classmethod
+    def attach(cls, unit):
+        """
+        Link unit and its subtree below unit.parent, replacing any links to previous ancestors.
+        """
+        subtree = list(cls.objects.filter(ancestor=unit).values_list('descendant', 'depth'))
+        if not subtree:
+            subtree = [(unit.pk, 0)]
+            cls.objects.create(ancestor=unit, descendant=unit, depth=0)
+        subtree_pks = [pk for pk, depth in subtree]
+        cls.objects.filter(descendant__in=subtree_pks).exclude(ancestor__in=subtree_pks).delete()
+        if unit.parent_id:
+            ancestors = cls.objects.filter(descendant=unit.parent_id).values_list('ancestor', 'depth')
+            cls.objects.bulk_create([
+                cls(ancestor_id=a, descendant_id=d, depth=a_depth + d_depth + 1)
+                for a, a_depth in ancestors for d, d_depth in subtree
+            ])
+
+    @classmethod
+    def detach(cls, unit):
+        """
+        Unlink the subtree below unit from unit and its ancestors, e.g. before unit is deleted and its
+        children become roots.
+        """
+        subtree = cls.objects.filter(ancestor=unit, depth__gte=1).values('descendant')
+        ancestors = cls.objects.filter(descendant=unit).values('ancestor')
+        cls.objects.filter(descendant__in=subtree, ancestor__in=ancestors).delete()
+
+    class Meta:
+        unique_together = ['ancestor', 'descendant']
+        indexes = [
+            models.Index(fields=['descendant', 'depth']),
+        ]
+
+
+@receiver(post_save, sender=Unit)
+def update_unit_closure(sender, instance, created, **kwargs):
+    parent = UnitClosure.objects.filter(descendant=instance, depth=1).values_list('ancestor', flat=True).first()
+    if created:
+        UnitClosure.attach(instance)
+    elif parent != instance.parent_id:
+        previous = list(instance.ancestor_links.filter(depth__gte=1).values_list('ancestor', flat=True))
+        UnitClosure.attach(instance)
+        current = list(instance.ancestor_links.filter(depth__gte=1).values_list('ancestor', flat=True))
+        KPIRollup.refresh(previous + current)
+
+
+@receiver(pre_delete, sender=Unit)
+def remove_unit_closure(sender, instance, **kwargs):
+    instance._rollup_ancestors = list(instance.ancestor_links.filter(depth__gte=1).values_list('ancestor', flat=True))
+    UnitClosure.detach(instance)
+
+
+@receiver(post_delete, sender=Unit)
+def remove_unit_rollups(sender, instance, **kwargs):
+    KPIRollup.refresh(getattr(instance, '_rollup_ancestors', []))
 
 
 class KPICategory(models.Model):
@@ -155,23 +293,54 @@ class KPI(models.Model):
     units = models.ManyToManyField(Unit, blank=True)
     kind = models.IntegerField(choices=TYPE, default=TYPE.SUM)
     priority = models.IntegerField(default=0)
+    code = models.CharField(max_length=10, blank=True, editable=False)
 
     def __str__(self):
         return self.name
 
     def priority_display(self):
-        letter = list(self.category.kpis.order_by('priority')).index(self)
-        return "{}{}".format(self.category.priority_display(), string.ascii_lowercase[letter])
+        return self.code
+
+    @classmethod
+    def refresh_codes(cls):
+        """
+        Recompute the display code (e.g. "3b") of every KPI from the category and KPI priorities
+        """
+        categories = {
+            pk: i + 1 for i, pk in enumerate(KPICategory.objects.order_by('priority', 'pk').values_list('pk', flat=True))
+        }
+        letters = {}
+        changed = []
+        for kpi in cls.objects.order_by('priority', 'pk').only('pk', 'category', 'code'):
+            code = ''
+            if kpi.category_id:
+                letter = letters.setdefault(kpi.category_id, 0)
+                letters[kpi.category_id] += 1
+                code = "{}{}".format(categories[kpi.category_id], string.ascii_lowercase[letter % 26])
+            if code != kpi.code:
+                kpi.code = code
+                changed.append(kpi)
+        cls.objects.bulk_update(changed, ['code'])
 
     def reporting_units(self):
-        units =  set(list(self.units.all()) + [i for sub in [u.descendants() for u in self.units.all()] for i in sub])
-        return [u for u in units if u.kind.reporter]
+        return list(Unit.tree.filter(
+            ancestor_links__ancestor__in=self.units.all(), kind__reporter=True
+        ).select_related('kind').distinct())
 
     class Meta:
         verbose_name = "Key Performance Indicator"
         ordering = ['category__priority', 'priority', ]
 
 
+def update_kpi_codes(sender, **kwargs):
+    KPI.refresh_codes()
+
+
+for model in [KPI, KPICategory]:
+    post_save.connect(update_kpi_codes, sender=model, dispatch_uid='update-kpi-codes-save-{}'.format(model.__name__))
+    post_delete.connect(update_kpi_codes, sender=model, dispatch_uid='update-kpi-codes-delete-{}'.format(model.__name__))
+
+
 class KPIFamily(models.Model):
     TYPE = Choices(
         (0, 'RELATED', _('Related')),
@@ -203,3 +372,182 @@ class KPIEntry(models.Model):
         verbose_name = "KPI Entry"
         verbose_name_plural = "KPI Entries"
         unique_together = ['kpi', 'unit', 'month']
+        indexes = [
+            # reports filter on units or a kpi and a range of months, and aggregate value by kpi and period
+            models.Index(fields=['unit', 'month'], include=['kpi', 'value'], name='kpientry_unit_month_idx'),
+            models.Index(fields=['kpi', 'month'], include=['unit', 'value'], name='kpientry_kpi_month_idx'),
+            models.Index(fields=['unit', 'month'], condition=models.Q(value__isnull=False),
+                         name='kpientry_unit_month_value_idx'),
+            models.Index(fields=['unit', 'month'], condition=models.Q(comments__gt=''),
+                         name='kpientry_unit_month_notes_idx'),
+        ]
+
+
+class KPIRollup(models.Model):
+    """
+    Monthly totals of KPIEntry values for a unit and all of its descendants. Kept up to date incrementally as
+    entries are saved or deleted and rebuilt with the kpi_rollup command.
+    """
+    unit = models.ForeignKey(Unit, on_delete=models.CASCADE, related_name="rollups")
+    kpi = models.ForeignKey(KPI, on_delete=models.CASCADE, related_name="rollups")
+    month = models.DateField()
+    value_sum = models.BigIntegerField(default=0)
+    entry_count = models.IntegerField(default=0)
+    value_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return "{}:{} | {}".format(self.unit_id, self.month, self.kpi_id)
+
+    @classmethod
+    def aggregate(cls, units=None):
+        """
+        Rollups computed directly from KPIEntry rows, for the given unit primary keys or for all units
+        """
+        entries = KPIEntry.objects.all()
+        if units is not None:
+            entries = entries.filter(unit__ancestor_links__ancestor__in=units)
+        return entries.order_by().values(
+            'kpi', 'month', rollup_unit=models.F('unit__ancestor_links__ancestor')
+        ).annotate(
+            value_sum=Coalesce(models.Sum('value'), 0), entry_count=models.Count('pk'), value_count=models.Count('value')
+        )
+
+    @classmethod
+    def refresh(cls, units=None):
+        """
+        Recompute the rollups for the given unit primary keys, or for all units
+        """
+        rollups = [
+            cls(unit_id=row['rollup_unit'], kpi_id=row['kpi'], month=row['month'], value_sum=row['value_sum'],
+                entry_count=row['entry_count'], value_count=row['value_count'])
+            for row in cls.aggregate(units=units)
+        ]
+        with transaction.atomic():
+            (cls.objects.all() if units is None else cls.objects.filter(unit__in=units)).delete()
+            cls.objects.bulk_create(rollups, batch_size=1000)
+        return len(rollups)
+
+    @classmethod
+    def refresh_entries(cls, keys):
+        """
+        Recompute only the rollups affected by writes to the entries with the given (unit, kpi, month) keys,
+        i.e. the rollups of those KPIs and months for the units and their ancestors
+        """
+        keys = {(unit, kpi, month.date() if isinstance(month, datetime) else month) for unit, kpi, month in keys}
+        ancestors = {}
+        for ancestor, unit in UnitClosure.objects.filter(
+                descendant__in={unit for unit, kpi, month in keys}).values_list('ancestor', 'descendant'):
+            ancestors.setdefault(unit, []).append(ancestor)
+        affected = {(pk, kpi, month) for unit, kpi, month in keys for pk in ancestors.get(unit, [])}
+
+        # the scope covers every combination of the units, KPIs and months, only the affected keys are written
+        units = {unit for unit, kpi, month in affected}
+        scope = dict(kpi__in={kpi for unit, kpi, month in keys}, month__in={month for unit, kpi, month in keys})
+        rollups = [
+            cls(unit_id=row['rollup_unit'], kpi_id=row['kpi'], month=row['month'], value_sum=row['value_sum'],
+                entry_count=row['entry_count'], value_count=row['value_count'])
+            for row in cls.aggregate(units=units).filter(**scope)
+            if (row['rollup_unit'], row['kpi'], row['month']) in affected
+        ]
+        stale = [
+            pk for pk, unit, kpi, month in cls.objects.filter(unit__in=units, **scope).values_list(
+                'pk', 'unit', 'kpi', 'month') if (unit, kpi, month) in affected
+        ]
+        with transaction.atomic():
+            cls.objects.filter(pk__in=stale).delete()
+            cls.objects.bulk_create(rollups, batch_size=1000)
+        return len(rollups)
+
+    @classmethod
+    def apply(cls, unit, kpi, month, value, sign=1, ancestors=None):
+        """
+        Add (sign=1) or remove (sign=-1) a single entry's contribution to the rollups of its unit and ancestors.
+        The ancestors of unit, including unit itself, are looked up unless given.
+        """
+        month = month.date() if isinstance(month, datetime) else month
+        if ancestors is None:
+            ancestors = list(UnitClosure.objects.filter(descendant=unit).values_list('ancestor', flat=True))
+        if sign > 0:
+            cls.objects.bulk_create([
+                cls(unit_id=pk, kpi_id=kpi, month=month) for pk in ancestors
+            ], ignore_conflicts=True)
+        rollups = cls.objects.filter(unit__in=ancestors, kpi=kpi, month=month)
+        rollups.update(
+            value_sum=models.F('value_sum') + sign * (value or 0),
+            entry_count=models.F('entry_count') + sign,
+            value_count=models.F('value_count') + sign * (value is not None)
+        )
+        if sign < 0:
+            rollups.filter(entry_count__lte=0).delete()
+
+    @classmethod
+    def replace(cls, unit, kpi, month, previous, value, ancestors=None):
+        """
+        Replace the contribution of an existing entry whose value changed from previous to value
+        """
+        month = month.date() if isinstance(month, datetime) else month
+        if ancestors is None:
+            ancestors = list(UnitClosure.objects.filter(descendant=unit).values_list('ancestor', flat=True))
+        cls.objects.filter(unit__in=ancestors, kpi=kpi, month=month).update(
+            value_sum=models.F('value_sum') + ((value or 0) - (previous or 0)),
+            value_count=models.F('value_count') + (int(value is not None) - int(previous is not None))
+        )
+
+    class Meta:
+        unique_together = ['unit', 'kpi', 'month']
+
+
+class PublicationCheckpoint(models.Model):
+    """
+    State of the last cls_publications import for a KPI and unit: a digest of the value and comments written
+    for every month, so that unchanged months are not rewritten.
+    """
+    kpi = models.ForeignKey(KPI, on_delete=models.CASCADE, related_name="checkpoints")
+    unit = models.ForeignKey(Unit, on_delete=models.CASCADE, related_name="checkpoints")
+    digests = models.JSONField(default=dict, blank=True)
+
+    def __str__(self):
+        return "{} | {}".format(self.unit_id, self.kpi_id)
+
+    class Meta:
+        unique_together = ['kpi', 'unit']
+
+
+@receiver(pre_save, sender=KPIEntry)
+def remember_entry(sender, instance, **kwargs):
+    instance._rollup_previous = instance.pk and KPIEntry.objects.filter(pk=instance.pk).values(
+        'unit', 'kpi', 'month', 'value').first() or None
+
+
+@receiver(post_save, sender=KPIEntry)
+def update_entry_rollups(sender, instance, **kwargs):
+    previous = getattr(instance, '_rollup_previous', None)
+    if previous:
+        KPIRollup.apply(previous['unit'], previous['kpi'], previous['month'], previous['value'], sign=-1)
+    KPIRollup.apply(instance.unit_id, instance.kpi_id, instance.month, instance.value)
+
+
+@receiver(post_delete, sender=KPIEntry)
+def remove_entry_rollups(sender, instance, **kwargs):
+    KPIRollup.apply(instance.unit_id, instance.kpi_id, instance.month, instance.value, sign=-1)
+
+
+def refresh_unit_entries(entries):
+    """
+    Bring rollups and cached reports up to date after bulk writes of the given KPIEntry rows, which bypass
+    the model signals
+    """
+    KPIRollup.refresh_entries({(entry.unit_id, entry.kpi_id, entry.month) for entry in entries})
+    caching.invalidate_reports()
+
+
+def invalidate_reports(sender, **kwargs):
+    caching.invalidate_reports()
+
+
+for model in [KPIEntry, KPI, KPIFamily, KPICategory, Unit, UnitType]:
+    post_save.connect(invalidate_reports, sender=model, dispatch_uid='invalidate-reports-save-{}'.format(model.__name__))
+    post_delete.connect(invalidate_reports, sender=model, dispatch_uid='invalidate-reports-delete-{}'.format(model.__name__))
+
+for through in [KPI.units.through, KPIFamily.kpis.through]:
+    m2m_changed.connect(invalidate_reports, sender=through, dispatch_uid='invalidate-reports-{}'.format(through.__name__))
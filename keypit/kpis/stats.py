@@ -1,186 +1,620 @@
-from django.db.models import Avg, Sum, Value, TextField, Func
-from django.db.models.functions import Concat
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db.models import (
+    Avg, Case, Count, F, FloatField, IntegerField, Max, Min, OuterRef, Prefetch, Q, Subquery, Sum, When, Window
+)
+from django.db.models.functions import (
+    Cast, Coalesce, ExtractMonth, ExtractYear, NullIf, Power, RowNumber, TruncMonth, TruncQuarter, TruncYear
+)
 from django.template.defaultfilters import linebreaksbr, mark_safe
+from django.utils import timezone
 
 import calendar
-from copy import deepcopy
-from datetime import datetime
+import json
+from datetime import date, datetime
 
-from .models import KPIEntry, KPI, KPIFamily
+from . import caching
+from .models import KPIEntry, KPI, KPIFamily, KPIRollup, Unit, UnitClosure
 
+REPORT_COMMENTS = getattr(settings, 'REPORT_COMMENTS', 10)     # comments per KPI in a report and per page
+FISCAL_YEAR_START = getattr(settings, 'FISCAL_YEAR_START', 4)   # first month of the fiscal year
+PERIODS = ['month', 'quarter', 'fiscal', 'year']
+PERIOD_TITLES = {'month': 'Month', 'quarter': 'Quarter', 'fiscal': 'Fiscal Year', 'year': 'Year'}
 HOUR_SECONDS = 3600
 COLORS = ["#006eb6", "#990099", "#512D6D", "#41864A", "#F0AD4E"]
 
 
+def month_range(year, quarter=None, month=None):
+    """
+    Filters selecting the months of a year, or of one quarter or month of it, as a range on month
+    which can use the indexes on month, unlike the year and quarter transforms
+    """
+    first, months = month and (int(month), 1) or quarter and (3 * int(quarter) - 2, 3) or (1, 12)
+    last = first + months - 1
+    return {
+        'month__gte': date(int(year), first, 1),
+        'month__lt': date(int(year) + last // 12, last % 12 + 1, 1),
+    }
+
+
+def span_range(start=None, end=None):
+    """
+    Filters selecting the months from start to end inclusive, given as dates or "YYYY-MM" strings. Either
+    end may be omitted.
+    """
+    filters = {}
+    if start:
+        start = datetime.strptime(start, '%Y-%m').date() if isinstance(start, str) else start
+        filters['month__gte'] = start.replace(day=1)
+    if end:
+        end = datetime.strptime(end, '%Y-%m').date() if isinstance(end, str) else end
+        filters['month__lt'] = date(end.year + end.month // 12, end.month % 12 + 1, 1)
+    return filters
+
+
+def period_bucket(period, field='month'):
+    """
+    SQL expression for the period of field: the first day of its month, quarter or year, or for fiscal
+    years, the calendar year in which its fiscal year starts (see FISCAL_YEAR_START)
+    """
+    if period == 'fiscal':
+        return Case(
+            When(**{'{}__month__gte'.format(field): FISCAL_YEAR_START, 'then': ExtractYear(field)}),
+            default=ExtractYear(field) - 1
+        )
+    return {'month': TruncMonth, 'quarter': TruncQuarter, 'year': TruncYear}[period](field)
+
+
+def period_label(period, key, years=False):
+    """
+    Display name of the period_bucket() key of period. Months and quarters include the year if years is True.
+    """
+    if period == 'month':
+        return years and key.strftime('%b %Y') or calendar.month_abbr[key.month]
+    elif period == 'quarter':
+        quarter = 'Q{}'.format((key.month - 1) // 3 + 1)
+        return years and '{} {}'.format(quarter, key.year) or quarter
+    elif period == 'fiscal':
+        return FISCAL_YEAR_START == 1 and 'FY{}'.format(key) or 'FY{}-{:02d}'.format(key, (key + 1) % 100)
+    return key.year
+
+
+def period_labels(period, keys):
+    """
+    Labels for the sorted period_bucket() keys of period, with the year included when they span several years
+    """
+    years = period in ['month', 'quarter'] and len({key.year for key in keys}) > 1
+    return {key: period_label(period, key, years) for key in keys}
+
+
 def get_data_periods(period='year', **filters):
     field = 'month__{}'.format(period)
     return sorted(KPIEntry.objects.filter(**filters).values_list(field, flat=True).distinct())
 
 
-class MonthCast(Func):
-   """
-   Coerce an expression to a new field type.
-   """
-   function = 'TO_CHAR'
-   template = '%(function)s(%(expressions)s, \'Month YYYY\')'
+COMMENT_ORDER = ['-month', 'unit__parent', 'unit']
 
 
-def unit_stats(period='month', year=None, **filters):
-    field = 'month__{}'.format(period)
+def format_comment(entry, units=True):
+    """
+    HTML for the comments of an entry dictionary with the keys unit__acronym, month and comments, headed by
+    the unit (if units) and month. Comments may contain HTML, such as publication lists.
+    """
+    return '<strong>{}{:%B %Y}</strong><br/>{}'.format(
+        units and '{} '.format(entry['unit__acronym']) or '', entry['month'], linebreaksbr(mark_safe(entry['comments']))
+    )
+
+
+def kpi_comments(entries, units=True, limit=REPORT_COMMENTS):
+    """
+    The first limit formatted comments of each KPI in entries and the number of comments of each KPI,
+    as {kpi: {'comments': [...], 'count': ...}}, from a single query
+    """
+    rows = entries.filter(comments__gt="").annotate(
+        row=Window(RowNumber(), partition_by=F('kpi'), order_by=[F('month').desc(), F('unit__parent'), F('unit')]),
+        total=Window(Count('pk'), partition_by=F('kpi')),
+    ).filter(row__lte=limit).order_by('row').values('kpi', 'unit__acronym', 'month', 'comments', 'total')
+    comments = {}
+    for row in rows:
+        info = comments.setdefault(row['kpi'], {'comments': [], 'count': row['total']})
+        info['comments'].append(format_comment(row, units))
+    return comments
+
+
+def comments_page(kpi_pk, page=1, period='month', year=None, subtree=None, per_page=REPORT_COMMENTS, **filters):
+    """
+    One page of the formatted comments of the KPI kpi_pk for the report unit_stats(**filters). The first page is
+    included in the report itself. Raises django.core.paginator.InvalidPage for pages out of range.
+    """
     entries = KPIEntry.objects.filter(**filters)
-    units = len(entries.values_list('unit', flat=True).distinct()) > 1
-
-    if entries.count():
-        categories = entries.values('kpi__category', 'kpi__category__name', 'kpi__category__description').distinct().order_by('kpi__category__priority')
-
-        periods = get_data_periods(period=period, **filters)
-        period_names = period == 'month' and [calendar.month_abbr[per].title() for per in periods] \
-                       or period == 'quarter' and ['Q{}'.format(per) for per in periods] \
-                       or periods
-        time_format = period == 'month' and '%b' or '%Y'
-
-        details = []
-        kpi_data = {}
-        summary_data = [[''] + period_names + ['Total / Avg']]
-        for cat in categories:
-            content = []
-            for kpi in KPI.objects.filter(category__id=cat['kpi__category'], pk__in=entries.values_list('kpi__id', flat=True).distinct()).order_by('priority'):
-                content += [{
-                    'title': kpi.name,
-                    'description': "<h4>{}. {}</h4><p>{}</p>".format(kpi.priority_display(), kpi.name, linebreaksbr(kpi.description)),
-                    'style': 'col-12 text-condensed px-5'
-                }]
+    units = entries.values('unit').distinct()[:2].count() > 1
+    paginator = Paginator(
+        entries.filter(kpi__pk=kpi_pk, comments__gt="").order_by(*COMMENT_ORDER).values('unit__acronym', 'month', 'comments'),
+        per_page
+    )
+    current = paginator.page(page)
+    return {
+        'comments': [format_comment(entry, units) for entry in current],
+        'count': paginator.count,
+        'page': current.number,
+        'next': current.has_next() and current.next_page_number() or None,
+    }
+
+
+def unit_tree():
+    """
+    The dendrogram of all units for the dashboard and the units grouped by kind, built in memory
+    from a single query
+    """
+    units = list(Unit.tree.select_related('kind').order_by('pk'))
+    children = {}
+    for unit in units:
+        children.setdefault(unit.parent_id, []).append(unit)
+
+    def dendrogram(unit):
+        return {
+            "name": unit.acronym,
+            "pk": unit.pk,
+            "children": [dendrogram(child) for child in children.get(unit.pk, [])]
+        }
+
+    # depth() of a unit does not count the root, so the deepest units are one level shallower than the tree
+    depth = 0
+    level = children.get(None, [])
+    while level:
+        level = [child for unit in level for child in children.get(unit.pk, [])]
+        depth += 1
+
+    kinds = {}
+    for unit in sorted([u for u in units if u.kind], key=lambda u: (u.kind_id, u.pk)):
+        kinds.setdefault(unit.kind.name, []).append(unit)
+
+    return {
+        'units': kinds,
+        'report': json.dumps({
+            "depth": 3 + max(depth - 2, 0),
+            "name": "KeyPIT",
+            "children": [dendrogram(unit) for unit in children.get(None, [])]
+        })
+    }
+
+
+def kpi_usage(kpis=None):
+    """
+    Annotate kpis (all KPIs by default) with their usage, in a single grouped query:
+        - beamlines_count: the number of reporting units tracking the KPI, as in KPI.reporting_units()
+        - entries_count: the number of entries
+        - reported_count: the number of entries with a value or comments
+        - first_month, last_month: the months of the first and last entries
+        - completeness: the fraction of reporting unit months from the first to the last month which
+          have been reported, or None if there are no entries
+    """
+    kpis = KPI.objects.all() if kpis is None else kpis
+    reporters = UnitClosure.objects.filter(
+        ancestor__kpi=OuterRef('pk'), descendant__kind__reporter=True
+    ).order_by().values('ancestor__kpi').annotate(count=Count('descendant', distinct=True)).values('count')
+    months = (
+        (ExtractYear('last_month') - ExtractYear('first_month')) * 12
+        + ExtractMonth('last_month') - ExtractMonth('first_month') + 1
+    )
+    return kpis.annotate(
+        beamlines_count=Coalesce(Subquery(reporters), 0),
+        entries_count=Count('entries', distinct=True),
+        reported_count=Count(
+            'entries', filter=Q(entries__value__isnull=False) | Q(entries__comments__gt=""), distinct=True
+        ),
+        first_month=Min('entries__month'),
+        last_month=Max('entries__month'),
+    ).annotate(
+        completeness=Cast('reported_count', FloatField()) / NullIf(F('beamlines_count') * months, 0),
+    )
+
+
+def completeness(year, unit=None):
+    """
+    The KPIs each reporting unit (below unit, if given) has not reported in the months of year up to the
+    current one. The expected (unit, kpi) pairs are derived from KPI.units and the unit tree as in
+    Unit.indicators() and matched against the entries with a value or comments in a single query.
+    Returns {'year', 'months', 'kpis': [{'id', 'code', 'name'}], 'units': [{'id', 'acronym', 'missing'}]},
+    where missing holds, for each of the kpis, None if the unit does not track it or a bitmask of the
+    months which have not been reported (bit 0 for January).
+    """
+    today = timezone.localdate()
+    year = int(year)
+    months = 12 if year < today.year else today.month if year == today.year else 0
+
+    reported = KPIEntry.objects.filter(
+        Q(value__isnull=False) | Q(comments__gt=""),
+        unit=OuterRef('descendant'), kpi=OuterRef('ancestor__kpi'), **month_range(year)
+    ).order_by().values('unit').annotate(
+        mask=Sum(Power(2, ExtractMonth('month') - 1), output_field=IntegerField())
+    ).values('mask')
+    links = UnitClosure.objects.filter(ancestor__kpi__isnull=False, descendant__kind__reporter=True).exclude(
+        ancestor__parent__isnull=True, depth__gte=1
+    )
+    if unit:
+        links = links.filter(descendant__in=UnitClosure.objects.filter(ancestor=unit).values('descendant'))
+    rows = links.order_by().values(
+        'descendant', 'descendant__acronym', 'ancestor__kpi', 'ancestor__kpi__code', 'ancestor__kpi__name',
+        'ancestor__kpi__priority', 'ancestor__kpi__category__priority',
+    ).annotate(reported=Coalesce(Subquery(reported), 0)).distinct()
+
+    expected = (1 << months) - 1
+    units = {}
+    kpis = {}
+    for row in rows:
+        kpis[row['ancestor__kpi']] = row
+        units.setdefault((row['descendant__acronym'], row['descendant']), {})[row['ancestor__kpi']] = (
+            expected & ~int(row['reported'])
+        )
+    kpis = sorted(kpis.values(), key=lambda row: (
+        row['ancestor__kpi__category__priority'] is None, row['ancestor__kpi__category__priority'],
+        row['ancestor__kpi__priority'], row['ancestor__kpi']
+    ))
+    return {
+        'year': year,
+        'months': [calendar.month_abbr[month] for month in range(1, months + 1)],
+        'kpis': [
+            {'id': row['ancestor__kpi'], 'code': row['ancestor__kpi__code'], 'name': row['ancestor__kpi__name']}
+            for row in kpis
+        ],
+        'units': [
+            {'id': pk, 'acronym': acronym, 'missing': [missing.get(row['ancestor__kpi']) for row in kpis]}
+            for (acronym, pk), missing in sorted(units.items())
+        ],
+    }
+
+
+def kpi_period_stats(period='month', subtree=None, **filters):
+    """
+    Aggregate all entries matching filters into periods (see period_bucket()) in a single GROUP BY query.
+    Returns a dictionary mapping each kpi primary key to a dictionary of
+    {period key: {'sum': ..., 'avg': ..., 'count': ..., 'values': ...}}, where 'values' is the number
+    of entries with a non-null value.
+
+    If subtree is a Unit and filters select exactly that unit and its descendants, the precomputed
+    KPIRollup rows of subtree are aggregated instead of the raw entries.
+    """
+    if subtree is not None:
+        rollup_filters = {k: v for k, v in filters.items() if k != 'unit__in'}
+        rows = KPIRollup.objects.filter(unit=subtree, **rollup_filters).annotate(
+            period=period_bucket(period)
+        ).order_by().values('kpi', 'period').annotate(
+            sum=Sum('value_sum'), count=Sum('entry_count'), values=Sum('value_count')
+        )
+        rows = [dict(row, avg=row['sum'] / row['values'] if row['values'] else None) for row in rows]
+    else:
+        rows = KPIEntry.objects.filter(**filters).annotate(period=period_bucket(period)).order_by().values(
+            'kpi', 'period'
+        ).annotate(
+            sum=Sum('value'), avg=Avg('value'), count=Count('pk'), values=Count('value')
+        )
+    data = {}
+    for row in rows:
+        data.setdefault(row['kpi'], {})[row['period']] = row
+    return data
+
 
-                kpi_filters = deepcopy(filters)
-                kpi_filters.update({'kpi': kpi})
-                kpi_entries = kpi.entries.filter(**kpi_filters)
-
-                kpi_comment_entries = kpi_entries.exclude(comments="").exclude(comments__isnull=True).order_by('-month', 'unit__parent', 'unit').annotate(
-                    str_month=MonthCast('month', output_field=TextField())).annotate(
-                    fmt_comments=Concat(Value('<strong>'), units and 'unit__acronym' or Value(''), Value(' '), 'str_month', Value('</strong><br/>'),
-                                        'comments', output_field=TextField())).values_list('fmt_comments', flat=True)
-
-                kpi_comments = '<br/><br/>'.join(kpi_comment_entries)
-                kpi_comments = linebreaksbr(mark_safe(kpi_comments))
-
-                if kpi.kind != kpi.TYPE.TEXT:
-                    # Add plots to the report
-                    kpi_filters.update({'value__isnull': False})
-                    kpi_periods = get_data_periods(period=period, **kpi_filters)
-                    kpi_entries.filter(**kpi_filters).order_by(field)
-                    total = '-'
-                    period_trend = {}
-                    if kpi.kind == kpi.TYPE.SUM:
-                        period_data = { p: kpi_entries.filter(**{field: p}).aggregate(sum=Sum('value'))['sum']
-                                        for p in kpi_periods }
-                        period_trend = { p: sum(list(period_data.values())[:i + 1]) for i, p in enumerate(kpi_periods)}
-                        if period_data:
-                            total = sum(list(period_data.values()))
-
-                    elif kpi.kind == kpi.TYPE.AVERAGE:
-                        period_data = {p: kpi_entries.filter(**{field: p}).exclude(value__isnull=True).aggregate(avg=Avg('value'))['avg']
-                                       for p in kpi_periods}
-                        period_data = {k: round(v, 1) or v for k, v in period_data.items()}
-                        if period_data:
-                            total = round(sum(period_data.values()) / len(period_data), 1)
-                    summary_data += [[kpi.name] + [period_data.get(p, '-') for p in periods] + [total]]
-
-                    if period_data:
-                        kpi_data[kpi.pk] = {
-                            period == 'year' and p or (period == 'month' and datetime.strftime(
-                                datetime(year, p, 1, 0, 0), '%b')) or 'Q{}'.format(p): v for p, v in
-                            period_data.items()}
-                        content += [{
-                            'style': 'col-lg-2 d-lg-block'
-                        }, {
-                            'title': kpi.name,
-                            'kind': 'columnchart',
-                            'data': {
-                                'colors': COLORS,
-                                'x-label': period.title(),
-                                'data': period_trend and [
-                                    { period.title(): p, "Value": v,
-                                      "Total": period_trend.get(period != 'year' and period_names.index(p)+1 or p, 0) }
-                                    for p, v in kpi_data[kpi.pk].items()
-                                ] or [
-                                    { period.title(): p, "Value": v }
-                                    for p, v in kpi_data[kpi.pk].items()
-                                ],
-                                'line': period_trend and "Total" or "",
-                            },
-                            'style': 'col-12 col-lg-8 px-5'
-                        }, {
-                            'style': 'col-lg-2 d-lg-block'
-                        }]
-                    else:
-                        content += [{
-                            'notes': "No data available",
-                            'style': 'col-12 px-5'
-                        }]
-
-                if kpi_comments or kpi.kind == kpi.TYPE.TEXT:
-                    # Add comments to the report
-                    content += [{
-                        'notes': kpi_comments or 'No data available',
-                        'style': 'col-12 px-5'
-                    }]
-
-            details.append({
-                'title': cat['kpi__category__name'],
-                'style': 'row',
-                'content': [cat['kpi__category__description'] and {
-                    'description': "<span class='text-bold text-large text-condensed'>STRATEGIC GOAL:</span>\n{}".format(
-                        cat['kpi__category__description']),
-                    'style': 'col-12 jumbotron pt-4 pb-2 text-muted'
-                }] + content
+def report_data(period='month', year=None, subtree=None, **filters):
+    """
+    The data shared by the summary and the category sections of the report of the entries matching filters:
+    the periods and their labels, the categories, whether the entries are from several units and, by
+    category, the KPIs with their values, running totals and overall total for every period. None if no
+    entries match.
+    """
+    period_stats = kpi_period_stats(period=period, subtree=subtree, **filters)
+    if not period_stats:
+        return None
+
+    entries = KPIEntry.objects.filter(**filters)
+    periods = sorted({p for kpi_periods in period_stats.values() for p in kpi_periods})
+    kpis = {}
+    for kpi in KPI.objects.filter(pk__in=period_stats.keys()).order_by('priority'):
+        period_data = {}
+        period_trend = {}
+        total = '-'
+        kpi_periods = {p: row for p, row in sorted(period_stats[kpi.pk].items()) if row['values']}
+        if kpi.kind == kpi.TYPE.SUM:
+            period_data = { p: row['sum'] for p, row in kpi_periods.items() }
+            period_trend = { p: sum(list(period_data.values())[:i + 1]) for i, p in enumerate(kpi_periods)}
+            if period_data:
+                total = sum(list(period_data.values()))
+
+        elif kpi.kind == kpi.TYPE.AVERAGE:
+            period_data = { p: row['avg'] for p, row in kpi_periods.items() }
+            period_data = {k: round(v, 1) or v for k, v in period_data.items()}
+            if period_data:
+                total = round(sum(period_data.values()) / len(period_data), 1)
+        kpis.setdefault(kpi.category_id, []).append({
+            'kpi': kpi, 'data': period_data, 'trend': period_trend, 'total': total
+        })
+
+    return {
+        'period': period,
+        'periods': periods,
+        'labels': period_labels(period, periods),
+        'units': entries.values('unit').distinct()[:2].count() > 1,
+        'categories': list(entries.values(
+            'kpi__category', 'kpi__category__name', 'kpi__category__description'
+        ).distinct().order_by('kpi__category__priority')),
+        'kpis': kpis,
+    }
+
+
+def report_summary(data):
+    """
+    The summary section of a report from report_data(): a table of the numeric KPIs in every period and a
+    chart of each KPI family
+    """
+    periods = data['periods']
+    labels = data['labels']
+    period_names = [labels[per] for per in periods]
+    period_title = PERIOD_TITLES[data['period']]
+
+    kpi_data = {}
+    summary_data = [[''] + period_names + ['Total / Avg']]
+    for cat in data['categories']:
+        for info in data['kpis'].get(cat['kpi__category'], []):
+            if info['kpi'].kind != KPI.TYPE.TEXT:
+                summary_data += [[info['kpi'].name] + [info['data'].get(p, '-') for p in periods] + [info['total']]]
+                if info['data']:
+                    kpi_data[info['kpi'].pk] = {labels[p]: v for p, v in info['data'].items()}
+
+    family_content = []
+    families = KPIFamily.objects.filter(
+        kpis__pk__in=[info['kpi'].pk for infos in data['kpis'].values() for info in infos]
+    ).distinct().prefetch_related(
+        Prefetch('kpis', queryset=KPI.objects.filter(pk__in=kpi_data.keys()), to_attr='report_kpis')
+    )
+    for family in families:
+        family_kpis = family.report_kpis
+        if len(family_kpis) > 1:
+            family_periods = {k for kpi in family_kpis for k in kpi_data[kpi.pk]}
+            family_data = []
+            for per in [name for name in period_names if name in family_periods]:
+                family_data.append({ period_title: per })
+            for f in family_data:
+                for kpi in family_kpis:
+                    f[kpi.name] = kpi_data[kpi.pk].get(f[period_title], 0)
+            family_content.append({
+                'title': family.name,
+                'kind': 'columnchart',
+                'data': {
+                    'colors': COLORS,
+                    'x-label': period_title,
+                    'data': family_data,
+                    'stack': family.kind == family.TYPE.CUMULATIVE and [[kpi.name for kpi in family_kpis]] or [],
+                },
+                'style': 'col-12 col-md-6 px-5'
             })
 
-        family_content = []
-        for family in KPIFamily.objects.filter(kpis__pk__in=entries.values_list('kpi__pk', flat=True)).distinct():
-            family_kpis = family.kpis.filter(pk__in=kpi_data.keys())
-            if family_kpis.count() > 1:
-                periods = []
-                for pk in family_kpis.values_list('pk', flat=True):
-                    for k in kpi_data[pk]:
-                        if k not in periods: periods.append(k)
-                if period == 'year':
-                    periods = sorted(periods)
-                elif period == 'month':
-                    periods = sorted(periods, key=lambda x: datetime.strptime(x, '%b').month)
-                family_data = []
-                for per in periods:
-                    family_data.append({ period.title(): per })
-                for f in family_data:
-                    for kpi in family_kpis:
-                        f[kpi.name] = kpi_data[kpi.pk].get(f[period.title()], 0)
-                family_content.append({
-                    'title': family.name,
+    return {
+        'title': 'Summary',
+        'style': 'row mb-4',
+        'content': [{
+            'kind': 'table',
+            'header': 'column row',
+            'data': summary_data,
+            'style': 'col-12'
+        }] + family_content
+    }
+
+
+def category_section(data, category, comments):
+    """
+    The section of a report from report_data() for one of its categories, with the first page of the
+    comments on each KPI from kpi_comments()
+    """
+    labels = data['labels']
+    period_title = PERIOD_TITLES[data['period']]
+    content = []
+    for info in data['kpis'].get(category['kpi__category'], []):
+        kpi = info['kpi']
+        content += [{
+            'title': kpi.name,
+            'description': "<h4>{}. {}</h4><p>{}</p>".format(kpi.priority_display(), kpi.name, linebreaksbr(kpi.description)),
+            'style': 'col-12 text-condensed px-5'
+        }]
+
+        if kpi.kind != kpi.TYPE.TEXT:
+            # Add plots to the report
+            period_data = info['data']
+            period_trend = info['trend']
+            if period_data:
+                content += [{
+                    'style': 'col-lg-2 d-lg-block'
+                }, {
+                    'title': kpi.name,
                     'kind': 'columnchart',
                     'data': {
                         'colors': COLORS,
-                        'x-label': period.title(),
-                        'data': family_data,
-                        'stack': family.kind == family.TYPE.CUMULATIVE and [[kpi.name for kpi in family_kpis]] or [],
+                        'x-label': period_title,
+                        'data': period_trend and [
+                            { period_title: labels[p], "Value": v, "Total": period_trend[p] }
+                            for p, v in period_data.items()
+                        ] or [
+                            { period_title: labels[p], "Value": v }
+                            for p, v in period_data.items()
+                        ],
+                        'line': period_trend and "Total" or "",
                     },
-                    'style': 'col-12 col-md-6 px-5'
-                })
+                    'style': 'col-12 col-lg-8 px-5'
+                }, {
+                    'style': 'col-lg-2 d-lg-block'
+                }]
+            else:
+                content += [{
+                    'notes': "No data available",
+                    'style': 'col-12 px-5'
+                }]
 
-        summary_table = [{
-            'title': 'Summary',
-            'style': 'row mb-4',
+        if kpi.pk in comments:
+            # Add the first page of comments to the report, the rest are fetched with comments_page()
+            content += [{
+                'kpi': kpi.pk,
+                'comments': comments[kpi.pk]['comments'],
+                'count': comments[kpi.pk]['count'],
+                'style': 'col-12 px-5'
+            }]
+        elif kpi.kind == kpi.TYPE.TEXT:
+            content += [{
+                'notes': 'No data available',
+                'style': 'col-12 px-5'
+            }]
+
+    return {
+        'title': category['kpi__category__name'],
+        'style': 'row',
+        'content': [category['kpi__category__description'] and {
+            'description': "<span class='text-bold text-large text-condensed'>STRATEGIC GOAL:</span>\n{}".format(
+                category['kpi__category__description']),
+            'style': 'col-12 jumbotron pt-4 pb-2 text-muted'
+        }] + content
+    }
+
+
+def unit_stats(period='month', year=None, subtree=None, **filters):
+    """
+    The report of the entries matching filters, in periods of a month, quarter, fiscal year or year. Ranges
+    of months are given as filters (see month_range() and span_range()).
+    """
+    data = report_data(period=period, subtree=subtree, **filters)
+    if not data:
+        return {'details': [{'title': 'No information', 'style': 'row mb-4'}]}
+    comments = kpi_comments(KPIEntry.objects.filter(**filters), units=data['units'])
+    return {'details': [report_summary(data)] + [
+        category_section(data, category, comments) for category in data['categories']
+    ]}
+
+
+def unit_comparison(kpis, period='month', year=None, unit=None, **filters):
+    """
+    Unit x period pivot of the numeric kpis for the units below unit (all units by default), from a single
+    GROUP BY (kpi, unit, period) query. Columnar: for each KPI, values[u][p] is the value of units[u] in
+    periods[p] and totals, ranks and shares are aligned with units. Values and totals are sums for SUM KPIs
+    and averages for AVERAGE KPIs, as in unit_stats(). Units are ranked by total, highest first, and shares
+    of the total of all units are given for SUM KPIs only. Periods and the range filters are as in unit_stats().
+    """
+    kpis = [kpi for kpi in kpis if kpi.kind != KPI.TYPE.TEXT]
+    if unit is not None:
+        filters['unit__in'] = UnitClosure.objects.filter(ancestor=unit).values('descendant')
+    rows = list(KPIEntry.objects.filter(kpi__in=kpis, value__isnull=False, **filters).annotate(
+        period=period_bucket(period)
+    ).order_by().values('kpi', 'unit', 'unit__acronym', 'period').annotate(sum=Sum('value'), avg=Avg('value')))
+
+    periods = sorted({row['period'] for row in rows})
+    units = sorted({(row['unit__acronym'], row['unit']) for row in rows})
+    cells = {(row['kpi'], row['unit'], row['period']): row for row in rows}
+    data = []
+    for kpi in kpis:
+        values = []
+        totals = []
+        for acronym, pk in units:
+            unit_values = []
+            for per in periods:
+                row = cells.get((kpi.pk, pk, per))
+                value = None
+                if row:
+                    value = row['sum'] if kpi.kind == KPI.TYPE.SUM else round(row['avg'], 1)
+                unit_values.append(value)
+            reported = [value for value in unit_values if value is not None]
+            total = None
+            if reported:
+                total = sum(reported) if kpi.kind == KPI.TYPE.SUM else round(sum(reported) / len(reported), 1)
+            values.append(unit_values)
+            totals.append(total)
+
+        ranked = [total for total in totals if total is not None]
+        grand = sum(ranked)
+        data.append({
+            'id': kpi.pk,
+            'name': kpi.name,
+            'kind': kpi.kind,
+            'values': values,
+            'totals': totals,
+            'ranks': [total is not None and 1 + len([t for t in ranked if t > total]) or None for total in totals],
+            'shares': [
+                round(total / grand, 4) if kpi.kind == KPI.TYPE.SUM and total is not None and grand else None
+                for total in totals
+            ],
+        })
+
+    return {
+        'period': period,
+        'year': year,
+        'periods': list(period_labels(period, periods).values()),
+        'units': [{'id': pk, 'acronym': acronym} for acronym, pk in units],
+        'kpis': data,
+    }
+
+
+def comparison_report(comparison):
+    """
+    A unit_comparison() pivot as a report: for each KPI, a column chart of the units in every period and a
+    table of their values, totals, ranks and shares
+    """
+    label = PERIOD_TITLES[comparison['period']]
+    details = []
+    for kpi in comparison['kpis']:
+        units = [
+            (unit, values, total, rank, share) for unit, values, total, rank, share in zip(
+                comparison['units'], kpi['values'], kpi['totals'], kpi['ranks'], kpi['shares']
+            ) if total is not None
+        ]
+        if not units:
+            continue
+        table = [[''] + comparison['periods'] + ['Total / Avg', 'Rank', 'Share']] + [
+            [unit['acronym']] + ['-' if value is None else value for value in values] + [
+                total, rank, share is None and '-' or '{:.1%}'.format(share)
+            ] for unit, values, total, rank, share in sorted(units, key=lambda u: u[3])
+        ]
+        details.append({
+            'title': kpi['name'],
+            'style': 'row',
             'content': [{
+                'title': kpi['name'],
+                'kind': 'columnchart',
+                'data': {
+                    'colors': COLORS,
+                    'x-label': label,
+                    'data': [
+                        dict({label: per}, **{unit['acronym']: values[i] for unit, values, _, _, _ in units})
+                        for i, per in enumerate(comparison['periods'])
+                    ],
+                },
+                'style': 'col-12 px-5'
+            }, {
                 'kind': 'table',
                 'header': 'column row',
-                'data': summary_data,
+                'data': table,
                 'style': 'col-12'
             }]
-        }]
-        for plot in family_content:
-            summary_table[0]['content'].append(plot)
-        stats = { 'details': summary_table + details }
-    else:
-        stats = { 'details': [{
-            'title': 'No information',
-            'style': 'row mb-4'
-        }]}
-    return stats
+        })
+    return {'details': details or [{'title': 'No information', 'style': 'row mb-4'}]}
+
+
+def report_outline(period='month', year=None, subtree=None, **filters):
+    """
+    The summary of a report followed by an empty placeholder for each category section, which carries the
+    number of the section to fetch with report_section(). Only the data shared by all sections is computed.
+    """
+    data = caching.cached_report(report_data, period=period, year=year, subtree=subtree, **filters)
+    if not data:
+        return {'details': [{'title': 'No information', 'style': 'row mb-4'}]}
+    return {'details': [report_summary(data)] + [
+        {'title': category['kpi__category__name'], 'style': 'row', 'section': i, 'content': []}
+        for i, category in enumerate(data['categories'], start=1)
+    ]}
+
+
+def report_section(section, period='month', year=None, subtree=None, **filters):
+    """
+    Category section number section of the report_outline() with the same arguments, or None
+    """
+    data = caching.cached_report(report_data, period=period, year=year, subtree=subtree, **filters)
+    if not data or not 0 < section <= len(data['categories']):
+        return None
+    category = data['categories'][section - 1]
+    kpis = [info['kpi'] for info in data['kpis'].get(category['kpi__category'], [])]
+    comments = kpi_comments(KPIEntry.objects.filter(kpi__in=kpis, **filters), units=data['units'])
+    return category_section(data, category, comments)
@@ -1,3 +1,368 @@
-from django.test import TestCase
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
 
-# Create your tests here.
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
+import json
+import tempfile
+import threading
+import time
+
+from keypit.kpis.client import APIClient
+from keypit.kpis import benchmark, caching, importer, middleware, stats
+from keypit.kpis.models import KPI, KPIEntry, KPIRollup, Manager, Unit, UnitType
+
+
+class StubServer(object):
+    """
+    Local HTTP server standing in for the USO and People APIs. Serves JSON from routes, a dictionary
+    mapping paths to (status, data), with an ETag derived from the data, and records every request.
+    """
+
+    def __init__(self, routes=None):
+        self.routes = routes or {}
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests.append((self.path, dict(self.headers)))
+                status, data = stub.routes.get(self.path, (404, {'detail': 'Not found'}))
+                body = json.dumps(data).encode('utf-8')
+                etag = '"{}"'.format(hash(body))
+                if status == 200 and self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class APIClientTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.client = APIClient(cache_dir=self.cache_dir.name, ttl=60)
+        self.stub = StubServer({'/roles/': (200, [{'code': 'employee'}])})
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_fresh_responses_are_served_from_cache(self):
+        with self.stub:
+            first = self.client.get(self.stub.url + '/roles/')
+            second = self.client.get(self.stub.url + '/roles/')
+        self.assertEqual(first.json(), [{'code': 'employee'}])
+        self.assertEqual(second.json(), first.json())
+        self.assertTrue(second.cached)
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertEqual((self.client.stats['misses'], self.client.stats['hits']), (1, 1))
+
+    def test_stale_responses_are_revalidated(self):
+        with self.stub:
+            first = self.client.get(self.stub.url + '/roles/')
+            with mock.patch('keypit.kpis.client.time.time', return_value=time.time() + 120):
+                second = self.client.get(self.stub.url + '/roles/')
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(self.stub.requests[1][1].get('If-None-Match'), first.headers['ETag'])
+        self.assertEqual(self.client.stats['revalidated'], 1)
+
+    def test_headers_are_part_of_the_cache_key(self):
+        with self.stub:
+            self.client.get(self.stub.url + '/roles/', headers={'Authorization': 'Bearer a'})
+            self.client.get(self.stub.url + '/roles/', headers={'Authorization': 'Bearer b'})
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_errors_are_not_cached(self):
+        with self.stub:
+            first = self.client.get(self.stub.url + '/missing/')
+            second = self.client.get(self.stub.url + '/missing/')
+        self.assertEqual((first.status_code, second.status_code), (404, 404))
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_stale_responses_are_served_when_offline(self):
+        with self.stub:
+            first = self.client.get(self.stub.url + '/roles/')
+        with mock.patch('keypit.kpis.client.time.time', return_value=time.time() + 120):
+            second = self.client.get(self.stub.url + '/roles/')
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(self.client.stats['errors'], 1)
+
+
+class ImportParsingTests(SimpleTestCase):
+
+    def test_export_csv_is_readable(self):
+        rows = importer.read_rows(b'unit,unit_name,category,kpi,month,value,comments\r\nBL1,Beamline,Users,Visits,2022-01-01,5,\r\n')
+        self.assertEqual(rows[0]['unit'], 'BL1')
+        self.assertEqual(importer.parse_month(rows[0]['month']), date(2022, 1, 1))
+        self.assertEqual(importer.parse_value(rows[0]['value']), 5)
+
+    def test_json_must_be_a_list_of_objects(self):
+        self.assertEqual(importer.read_rows('[{"unit": "BL1"}]', 'json'), [{'unit': 'BL1'}])
+        with self.assertRaises(ValueError):
+            importer.read_rows('{"unit": "BL1"}', 'json')
+
+    def test_invalid_values(self):
+        self.assertIsNone(importer.parse_value(' '))
+        self.assertEqual(importer.parse_month('2022-03-15'), date(2022, 3, 1))
+        for func, value in [(importer.parse_value, '1.5'), (importer.parse_month, '2022-13'), (importer.parse_month, None)]:
+            with self.assertRaises(ValueError):
+                func(value)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Units can only be stored on PostgreSQL')
+class EntryImportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        root = Unit.tree.create(name='Facility', acronym='FAC', kind=UnitType.objects.create(name='Facility'))
+        division = Unit.tree.create(name='Division', acronym='DIV', parent=root)
+        cls.unit = Unit.tree.create(name='Beamline', acronym='BL1', parent=division)
+        cls.kpi = KPI.objects.create(name='Visits')
+        cls.kpi.units.add(division)
+        KPIEntry.objects.create(unit=cls.unit, kpi=cls.kpi, month=date(2022, 1, 1), value=5, comments='Note')
+
+    def rollups(self):
+        return sorted(KPIRollup.objects.values_list('unit', 'month', 'value_sum', 'entry_count', 'value_count'))
+
+    def save(self, rows):
+        entries = importer.EntryImport(rows, unit=self.unit)
+        self.assertTrue(entries.validate())
+        return entries.save()
+
+    def test_missing_fields_are_kept(self):
+        self.save([{'kpi': self.kpi.pk, 'month': '2022-01', 'value': 7}])
+        self.assertEqual(KPIEntry.objects.values_list('value', 'comments').get(), (7, 'Note'))
+        self.save([{'kpi': self.kpi.pk, 'month': '2022-01', 'comments': 'Edited'}])
+        self.assertEqual(KPIEntry.objects.values_list('value', 'comments').get(), (7, 'Edited'))
+
+    def test_rollups_follow_changes(self):
+        rows = [
+            {'kpi': self.kpi.pk, 'month': '2022-01', 'value': None},
+            {'kpi': self.kpi.pk, 'month': '2022-02', 'value': 3},
+        ]
+        for limit in [importer.IMPORT_DELTA_LIMIT, 1]:
+            with mock.patch.object(importer, 'IMPORT_DELTA_LIMIT', limit):
+                self.assertEqual(self.save(rows), 2)
+                self.assertEqual(self.rollups(), sorted(
+                    (row['rollup_unit'], row['month'], row['value_sum'], row['entry_count'], row['value_count'])
+                    for row in KPIRollup.aggregate()
+                ))
+            rows = [dict(row, value=(row['value'] or 0) + 1) for row in rows]
+
+    def test_ambiguous_unit_acronyms(self):
+        Unit.tree.create(name='Other Beamline', acronym='BL1', parent=self.unit.parent)
+        rows = [{'unit': 'BL1', 'kpi': self.kpi.pk, 'month': '2022-01', 'value': 1}]
+        entries = importer.EntryImport(rows)
+        self.assertFalse(entries.validate())
+        self.assertEqual(entries.errors, [(1, 'Unit acronym "BL1" is ambiguous, use the unit id')])
+        self.assertEqual(self.save([dict(rows[0], unit=self.unit.pk)]), 1)
+
+    def test_grid_rejects_invalid_months(self):
+        self.client.force_login(Manager.objects.create_superuser(username='admin', email='', password=None))
+        url = reverse('unit-entry-grid', args=[self.unit.pk])
+        self.assertEqual(self.client.get(url, {'year': 2022, 'month': 1}).status_code, 200)
+        for query in [{'month': 13}, {'month': 0}, {'year': 0}, {'year': 10000}, {'month': 'x'}]:
+            self.assertEqual(self.client.get(url, query).status_code, 400)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Query plans are only checked on PostgreSQL')
+class KPIEntryIndexTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        kind = UnitType.objects.create(name='Beamline', reporter=True)
+        cls.units = [Unit.tree.create(name='Unit {}'.format(i), acronym='U{}'.format(i), kind=kind) for i in range(4)]
+        cls.kpis = [KPI.objects.create(name='KPI {}'.format(i), priority=i) for i in range(4)]
+        KPIEntry.objects.bulk_create([
+            KPIEntry(unit=unit, kpi=kpi, month=date(year, month, 1), value=month % 3 and month or None,
+                     comments=month == 6 and 'Note' or '')
+            for unit in cls.units for kpi in cls.kpis for year in range(2000, 2020) for month in range(1, 13)
+        ])
+
+    def plan(self, queryset):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE kpis_kpientry')
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+    def test_unit_reports_use_unit_month_index(self):
+        entries = KPIEntry.objects.filter(unit__in=self.units[:2], **stats.month_range(2010, quarter=2))
+        self.assertIn('kpientry_unit_month', self.plan(entries.values('kpi', 'value')))
+
+    def test_kpi_reports_use_kpi_month_index(self):
+        entries = KPIEntry.objects.filter(kpi=self.kpis[0], **stats.month_range(2010))
+        self.assertIn('kpientry_kpi_month_idx', self.plan(entries.values('unit', 'value')))
+
+    def test_comments_use_partial_index(self):
+        entries = KPIEntry.objects.filter(unit__in=self.units[:2], comments__gt='', **stats.month_range(2010))
+        self.assertIn('kpientry_unit_month_notes_idx', self.plan(entries.values('kpi', 'comments')))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Units can only be stored on PostgreSQL')
+class ReportBenchmarkTests(TestCase):
+    """
+    Guards the report functions and pages against query regressions. Timing and memory baselines depend on
+    the machine and are only enforced by the benchmark management command.
+    """
+
+    def measure(self, **options):
+        with transaction.atomic():
+            results = benchmark.run(benchmark.generate(**options), repeat=1)
+            transaction.set_rollback(True)
+        return results
+
+    def test_queries_within_baselines(self):
+        results = self.measure(depth=2, width=2, kpis=8, years=1)
+        self.assertEqual(benchmark.compare(results, benchmark.load_baselines(), tolerance=float('inf')), [])
+
+    def test_queries_do_not_grow_with_data(self):
+        small = self.measure(depth=2, width=2, kpis=8, years=1)
+        large = self.measure(depth=3, width=3, kpis=16, years=3)
+        self.assertEqual(
+            {name: result['queries'] for name, result in large.items()},
+            {name: result['queries'] for name, result in small.items()}
+        )
+
+
+def sample_report(**kwargs):
+    return kwargs
+
+
+class ReportCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        caching.report_cache().clear()
+
+    def cached(self, n):
+        return caching.report_cache().get(caching.report_key(report='sample_report', n=n)) is not None
+
+    @mock.patch.object(caching, 'REPORT_CACHE_SIZE', 3)
+    def test_least_recently_used_evicted(self):
+        for n in [0, 1, 2, 0, 3]:
+            caching.cached_report(sample_report, n=n)
+        self.assertEqual([self.cached(n) for n in range(4)], [True, False, True, True])
+
+    def test_invalidate(self):
+        caching.cached_report(sample_report, n=0)
+        caching.invalidate_reports()
+        self.assertFalse(self.cached(0))
+
+    def test_private_cache_warning(self):
+        self.assertEqual(caching.check_report_cache(None), [])
+        with mock.patch.object(caching, 'REPORT_CACHE', 'default'):
+            self.assertEqual([w.id for w in caching.check_report_cache(None)], ['kpis.W001'])
+
+
+class RequestStatsTests(SimpleTestCase):
+
+    def test_percentiles_per_view(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.log') as log:
+            for i in range(1, 101):
+                log.write(json.dumps({
+                    'view': i % 2 and 'dashboard' or 'unit-report', 'total_ms': i, 'db_ms': 1, 'template_ms': 2,
+                    'queries': 4, 'slow': i > 95,
+                }) + '\n')
+            log.write('not json\n')
+            log.flush()
+            stats = middleware.request_stats(log.name)
+        self.assertEqual(sorted(stats.keys()), ['dashboard', 'unit-report'])
+        self.assertEqual(stats['unit-report']['requests'], 50)
+        self.assertEqual(stats['unit-report']['slow'], 3)
+        self.assertEqual(stats['unit-report']['total_ms'], {'p50': 50, 'p90': 90, 'p99': 100, 'max': 100})
+        self.assertEqual(stats['dashboard']['queries']['p99'], 4)
+
+    def test_missing_log(self):
+        self.assertEqual(middleware.request_stats('/nonexistent/requests.log'), {})
+
+
+class ReportCommentTests(SimpleTestCase):
+
+    def test_format_comment(self):
+        entry = {'unit__acronym': 'CMCF', 'month': date(2021, 3, 1), 'comments': '<i>Paper</i>\nSecond line'}
+        self.assertEqual(
+            stats.format_comment(entry), '<strong>CMCF March 2021</strong><br/><i>Paper</i><br>Second line'
+        )
+        self.assertTrue(stats.format_comment(entry, units=False).startswith('<strong>March 2021</strong>'))
+
+
+class ComparisonReportTests(SimpleTestCase):
+
+    def test_ranked_table(self):
+        comparison = {
+            'period': 'quarter', 'year': 2021, 'periods': ['Q1', 'Q2'],
+            'units': [{'id': 1, 'acronym': 'BL1'}, {'id': 2, 'acronym': 'BL2'}, {'id': 3, 'acronym': 'BL3'}],
+            'kpis': [{
+                'id': 1, 'name': 'Visits', 'kind': KPI.TYPE.SUM, 'values': [[1, 2], [6, None], [None, None]],
+                'totals': [3, 6, None], 'ranks': [2, 1, None], 'shares': [0.3333, 0.6667, None],
+            }],
+        }
+        content = stats.comparison_report(comparison)['details'][0]['content']
+        self.assertEqual(content[0]['data']['data'], [{'Quarter': 'Q1', 'BL1': 1, 'BL2': 6}, {'Quarter': 'Q2', 'BL1': 2, 'BL2': None}])
+        self.assertEqual(content[1]['data'][1:], [['BL2', 6, '-', 6, 1, '66.7%'], ['BL1', 1, 2, 3, 2, '33.3%']])
+
+
+class ReportPeriodTests(SimpleTestCase):
+
+    def test_span_range(self):
+        self.assertEqual(
+            stats.span_range('2020-04', '2021-12'), {'month__gte': date(2020, 4, 1), 'month__lt': date(2022, 1, 1)}
+        )
+        self.assertEqual(stats.span_range(end=date(2021, 3, 15)), {'month__lt': date(2021, 4, 1)})
+        with self.assertRaises(ValueError):
+            stats.span_range('2020')
+
+    def test_period_labels(self):
+        keys = [date(2020, 10, 1), date(2021, 1, 1)]
+        self.assertEqual(list(stats.period_labels('quarter', keys).values()), ['Q4 2020', 'Q1 2021'])
+        self.assertEqual(list(stats.period_labels('month', keys[1:]).values()), ['Jan'])
+        with mock.patch.object(stats, 'FISCAL_YEAR_START', 4):
+            self.assertEqual(stats.period_label('fiscal', 2020), 'FY2020-21')
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Units can only be stored on PostgreSQL')
+class PeriodStatsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.root = Unit.tree.create(name='Facility', acronym='FAC', kind=UnitType.objects.create(name='Facility'))
+        units = [Unit.tree.create(name=name, acronym=name, parent=cls.root) for name in ['BL1', 'BL2']]
+        cls.kpi = KPI.objects.create(name='Visits')
+        for unit, month, value in [
+            (units[0], date(2021, 3, 1), 1), (units[0], date(2021, 4, 1), 2), (units[1], date(2021, 4, 1), 4),
+            (units[0], date(2021, 6, 1), 8), (units[0], date(2022, 1, 1), 16), (units[1], date(2022, 3, 1), 32),
+        ]:
+            KPIEntry.objects.create(unit=unit, kpi=cls.kpi, month=month, value=value)
+        cls.units = [cls.root] + units
+
+    def sums(self, period, **kwargs):
+        data = stats.kpi_period_stats(period=period, unit__in=self.units, **kwargs)
+        return {key: row['sum'] for key, row in data[self.kpi.pk].items()}
+
+    def test_fiscal_and_quarter_buckets(self):
+        quarters = {date(2021, 1, 1): 1, date(2021, 4, 1): 14, date(2022, 1, 1): 48}
+        with mock.patch.object(stats, 'FISCAL_YEAR_START', 4):
+            for subtree in [None, self.root]:
+                self.assertEqual(self.sums('fiscal', subtree=subtree), {2020: 1, 2021: 62})
+                self.assertEqual(self.sums('quarter', subtree=subtree), quarters)
@@ -11,6 +11,7 @@ urlpatterns = [
     path('units/<int:pk>/widget/', views.UnitDetail.as_view(template_name='kpis/entries/unit-widget.html'), name='unit-widget'),
     path('units/<int:pk>/<int:year>/<str:period>/', views.UnitDetail.as_view(), name='unit-year'),
     path('units/<int:pk>/<int:year>/month/<int:month>/', views.UnitReport.as_view(), name='unit-report'),
+    path('units/<int:pk>/entries/', views.UnitEntryGrid.as_view(), name='unit-entry-grid'),
     path('units/new/', views.UnitCreate.as_view(), name='new-unit'),
     path('units/<int:pk>/edit/', views.UnitEdit.as_view(), name='unit-edit'),
 
@@ -23,7 +24,16 @@ urlpatterns = [
     path('kpis/<int:pk>/', views.KPIDetail.as_view(), name='kpi-detail'),
     path('kpis/<int:pk>/<int:year>/<str:period>/', views.KPIDetail.as_view(), name='kpi-year'),
     path('kpis/<int:pk>/edit/', views.KPIEdit.as_view(), name='kpi-edit'),
+    path('kpis/compare/', views.KPIComparison.as_view(), name='kpi-compare'),
+    path('kpis/compare/<int:year>/<str:period>/', views.KPIComparison.as_view(), name='kpi-compare-year'),
 
     path('entries/new/', views.KPIEntryCreate.as_view(), name='kpientry-new'),
+    path('entries/import/', views.KPIEntryImport.as_view(), name='kpientry-import'),
+    path('entries/export/', views.KPIEntryExport.as_view(), name='kpientry-export'),
     path('entries/<int:pk>/edit/', views.KPIEntryEdit.as_view(), name='kpientry-edit'),
+
+    path('completeness/', views.Completeness.as_view(), name='completeness'),
+    path('completeness/<int:year>/', views.Completeness.as_view(), name='completeness-year'),
+
+    path('performance/', views.PerformanceStats.as_view(), name='performance-stats'),
 ]
\ No newline at end of file
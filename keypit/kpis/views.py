@@ -1,14 +1,17 @@
 from django.contrib.messages.views import SuccessMessageMixin
-from django.db.models import Subquery, OuterRef
-from django.http import HttpResponseRedirect, Http404
+from django.db.models import F, FilteredRelation, Q
+from django.http import FileResponse, HttpResponseBadRequest, HttpResponseRedirect, Http404, JsonResponse, StreamingHttpResponse
 from django.template.defaultfilters import linebreaksbr
 from django.urls import reverse_lazy
-from django.views.generic import edit, detail, View
+from django.utils.functional import cached_property
+from django.views.generic import edit, detail, TemplateView, View
 
 from itemlist.views import ItemListView
 from datetime import datetime
+import json
+import tempfile
 
-from keypit.kpis import models, forms
+from keypit.kpis import caching, export, importer, middleware, models, forms, stats
 from keypit.mixins.views import *
 
 
@@ -54,15 +57,9 @@ class Dashboard(UserRoleMixin, detail.DetailView):
 
     def get_context_data(self, **kwargs):
         context = super(Dashboard, self).get_context_data(**kwargs)
-        units = {
-            kind.name: models.Unit.tree.filter(kind=kind) for kind in models.UnitType.objects.all()
-        }
-        context['units'] = {k: v for k, v in units.items() if v}
-        context['report'] = {
-            "depth": 3 + max([max([d.depth() for d in u.descendants()] + [0]) for u in models.Unit.tree.filter(parent__isnull=True)]),
-            "name": "KeyPIT",
-            "children": [ unit.dendrogram() for unit in models.Unit.tree.filter(parent__isnull=True) ]
-        }
+        tree = caching.cached_report(stats.unit_tree)
+        context['units'] = tree['units']
+        context['report'] = tree['report']
 
         return context
 
@@ -71,6 +68,7 @@ class UnitList(UserRoleMixin, ListViewMixin, ItemListView):
     model = models.Unit
     list_filters = ['parent', ]
     list_columns = ['acronym', 'name', 'kind__name', 'parent']
+    list_select_related = ['kind', 'parent']
     list_search = ['name', 'acronym']
     link_url = 'unit-detail'
     add_url = 'new-unit'
@@ -90,13 +88,18 @@ class UnitDetail(UserRoleMixin, ReportViewMixin, detail.DetailView):
     def get_filters(self):
         return {'unit__in': [self.object] + list(self.object.descendants())}
 
+    def get_subtree(self):
+        return self.object
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        units = {
-            kind.name: models.Unit.tree.filter(pk__in=self.object.children.values_list('pk', flat=True), kind=kind)
-            for kind in models.UnitType.objects.all()
-        }
-        context['units'] = {k: v for k, v in units.items() if v}
+        units = {}
+        children = models.Unit.tree.filter(
+            pk__in=self.object.children.values_list('pk', flat=True), kind__isnull=False
+        ).select_related('kind')
+        for unit in sorted(children, key=lambda u: u.kind_id):
+            units.setdefault(unit.kind.name, []).append(unit)
+        context['units'] = units
         return context
 
 
@@ -116,47 +119,111 @@ class UnitReport(UserRoleMixin, detail.DetailView):
         context = super().get_context_data(**kwargs)
         year = self.kwargs.pop('year')
         month = self.kwargs.pop('month')
+        month_filters = stats.month_range(year, month=month)
 
-        entry = models.KPIEntry.objects.filter(
-            month__year=year, month__month=month, unit=self.object, kpi__pk=OuterRef('pk'))
+        # one query: the unit's indicators LEFT JOINed to their entry for the month, grouped by category here
         indicators = self.object.indicators().annotate(
-            entry=Subquery(entry.values('pk')[:1]),
-            value=Subquery(entry.values('value')[:1]),
-            comments=Subquery(entry.values('comments')[:1])
+            month_entry=FilteredRelation('entries', condition=Q(
+                entries__unit=self.object, entries__month__gte=month_filters['month__gte'],
+                entries__month__lt=month_filters['month__lt']
+            ))
+        ).annotate(
+            entry=F('month_entry__pk'), value=F('month_entry__value'), comments=F('month_entry__comments')
+        ).select_related('category').order_by(
+            F('category__priority').asc(nulls_last=True), 'category__pk', 'priority'
         )
 
-        entries = self.object.entries.filter(
-            month__year=year, month__month=month).order_by('kpi__category__priority', 'kpi__priority')
-        categories = models.KPICategory.objects.filter(
-            pk__in=entries.values_list('kpi__category__id', flat=True).distinct())
-        context['categories'] = {
-            cat: entries.filter(kpi__category=cat) for cat in categories
-        }
-        if entries.filter(kpi__category__isnull=True).exists():
-            context['categories']['Other'] = entries.filter(kpi__category__isnull=True)
+        seen = set()
+        context['categories'] = {}
+        for kpi in indicators:
+            if kpi.pk not in seen:
+                seen.add(kpi.pk)
+                context['categories'].setdefault(kpi.category or 'Other', []).append(kpi)
 
         filters = {'unit': self.object}
         context['years'] = stats.get_data_periods(period='year', **filters)
         if timezone.localtime().year not in context['years']:
             context['years'].append(timezone.localtime().year)
 
-        filters['month__year'] = year
+        filters.update(stats.month_range(year))
         context['months'] = stats.get_data_periods(period='month', **filters)
         context['quarters'] = stats.get_data_periods(period='quarter', **filters)
         context['year'] = year
         context['month'] = month
 
-        categories = models.KPICategory.objects.filter(
-            pk__in=indicators.values_list('category__id', flat=True).distinct())
-        context['categories'] = {
-            cat: indicators.filter(category=cat) for cat in categories
-        }
-        if indicators.filter(category__isnull=True).exists():
-            context['categories']['Other'] = indicators.filter(category__isnull=True)
-
         return context
 
 
+class UnitEntryGrid(OwnerRequiredMixin, detail.DetailView):
+    """
+    Spreadsheet-style entry grid for the indicators of a unit. GET returns the cells of a year (or a single month)
+    and POST applies a JSON patch of many cells, {"cells": [{"kpi", "month", "value", "comments"}, ...]}, in one
+    transaction, returning only the cells which changed. A cell without a value or comments keeps the stored one.
+    """
+    model = models.Unit
+    http_method_names = ['get', 'post']
+
+    def owner_roles(self):
+        return self.get_object().owner_roles()
+
+    def cell(self, kpi, month, value, comments, entry=None):
+        return {'kpi': kpi, 'month': month.strftime('%Y-%m'), 'value': value, 'comments': comments, 'entry': entry}
+
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        try:
+            year = int(request.GET.get('year', timezone.localtime().year))
+            month = int(request.GET['month']) if request.GET.get('month') else None
+            if month is not None and not 1 <= month <= 12:
+                raise ValueError
+            months = stats.month_range(year, month=month)
+        except ValueError:
+            return HttpResponseBadRequest('The year and month must be valid numbers')
+        entries = self.object.entries.filter(**months)
+        kpis = self.object.indicators().distinct().select_related('category').order_by('category__priority', 'priority')
+        return JsonResponse({
+            'unit': self.object.pk,
+            'kpis': [
+                {'id': kpi.pk, 'name': kpi.name, 'kind': kpi.kind, 'code': kpi.code,
+                 'category': kpi.category and kpi.category.name} for kpi in kpis
+            ],
+            'cells': [
+                self.cell(kpi, entry_month, value, comments, pk) for pk, kpi, entry_month, value, comments in
+                entries.values_list('pk', 'kpi', 'month', 'value', 'comments')
+            ],
+        })
+
+    def post(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        try:
+            patch = json.loads(request.body)
+        except ValueError:
+            return HttpResponseBadRequest('The patch must be JSON')
+        cells = patch.get('cells') if isinstance(patch, dict) else patch
+        if not isinstance(cells, list) or not all(isinstance(cell, dict) for cell in cells):
+            return HttpResponseBadRequest('The patch must be a list of cells')
+
+        rows = [{k: v for k, v in cell.items() if k != 'unit'} for cell in cells]
+        grid = importer.EntryImport(rows, unit=self.object)
+        if not grid.validate():
+            return JsonResponse({
+                'cells': [], 'errors': [{'cell': line - 1, 'error': error} for line, error in grid.errors]
+            }, status=400)
+        grid.save()
+
+        changed = [entry for line, action, entry, previous in grid.changes if action != 'unchanged']
+        pks = dict(((kpi, month), pk) for pk, kpi, month in self.object.entries.filter(
+            kpi__in={entry.kpi.pk for entry in changed}, month__in={entry.month for entry in changed}
+        ).values_list('pk', 'kpi', 'month')) if changed else {}
+        return JsonResponse({
+            'cells': [
+                self.cell(entry.kpi.pk, entry.month, entry.value, entry.comments, pks.get((entry.kpi.pk, entry.month)))
+                for entry in changed
+            ],
+            'errors': [],
+        })
+
+
 class UnitCreate(AdminRequiredMixin, SuccessMessageMixin, AsyncFormMixin, edit.CreateView):
     form_class = forms.UnitForm
     template_name = "modal/form.html"
@@ -178,9 +245,13 @@ class UnitEdit(OwnerRequiredMixin, SuccessMessageMixin, AsyncFormMixin, edit.Upd
 
 class KPIList(UserRoleMixin, ListViewMixin, ItemListView):
     model = models.KPI
+    queryset = stats.kpi_usage()
     list_filters = ['category', 'kind']
-    list_columns = ['name', 'category', 'description', 'kind', 'base_units']
+    list_columns = ['name', 'category', 'description', 'kind', 'base_units', 'beamlines_count', 'entries_count']
+    list_headers = {'beamlines_count': 'Reporting Units', 'entries_count': 'Entries'}
     list_transforms = {'description': format_description, 'base_units': format_reporters}
+    list_select_related = ['category']
+    list_prefetch = ['units']
     list_search = ['name', 'description']
     link_url = 'kpi-detail'
     add_url = 'new-kpi'
@@ -199,13 +270,58 @@ class KPIDetail(UserRoleMixin, ReportViewMixin, detail.DetailView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        pks = [u.pk for u in self.object.reporting_units()]
-        units = {
-            kind.name: models.Unit.tree.filter(pk__in=pks, kind=kind) for kind in models.UnitType.objects.all()
-        }
-        context['units'] = {k: v for k, v in units.items() if v}
+        units = {}
+        for unit in sorted(self.object.reporting_units(), key=lambda u: (u.kind_id, u.pk)):
+            units.setdefault(unit.kind.name, []).append(unit)
+        context['units'] = units
+        context['usage'] = stats.kpi_usage(models.KPI.objects.filter(pk=self.object.pk)).get()
+        return context
+
+
+class KPIComparison(UserRoleMixin, TemplateView):
+    """
+    Compare the units reporting one or more KPIs (?kpi=<pk>&kpi=<pk>), optionally below ?unit=<pk>, over the
+    periods of one year, or of all years or the months from ?start=YYYY-MM to ?end=YYYY-MM in periods of
+    ?period=<period>. Clients not accepting HTML receive the columnar pivot as JSON.
+    """
+    template_name = "kpis/entries/kpi-compare.html"
+
+    def get_comparison(self):
+        try:
+            pks = [int(pk) for pk in self.request.GET.getlist('kpi')]
+            unit = self.request.GET.get('unit') and int(self.request.GET['unit'])
+            filters = stats.span_range(self.request.GET.get('start'), self.request.GET.get('end'))
+        except ValueError:
+            raise Http404()
+        self.kpis = list(models.KPI.objects.filter(pk__in=pks).order_by('category__priority', 'priority'))
+        self.unit = unit and models.Unit.tree.filter(pk=unit).first()
+        year = self.kwargs.get('year')
+        period = self.kwargs.get('period') or self.request.GET.get('period', 'year')
+        if not self.kpis or (unit and not self.unit) or period not in stats.PERIODS or (year and period == 'fiscal'):
+            raise Http404()
+        if year:
+            filters = stats.month_range(year)
+        return caching.cached_report(
+            stats.unit_comparison, kpis=self.kpis, period=period, year=year, unit=self.unit, **filters
+        )
+
+    def get(self, request, *args, **kwargs):
+        if not request.accepts('text/html'):
+            return JsonResponse(self.get_comparison())
+        return super().get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        comparison = self.get_comparison()
+        context.update(
+            kpis=self.kpis, unit=self.unit, year=comparison['year'], period=comparison['period'],
+            report=json.dumps(stats.comparison_report(comparison)),
+            years=stats.get_data_periods(period='year', kpi__in=self.kpis),
+            query=self.request.GET.urlencode(),
+        )
         return context
 
+
 class KPICreate(AdminRequiredMixin, SuccessMessageMixin, AsyncFormMixin, edit.CreateView):
     form_class = forms.KPIForm
     template_name = "modal/form.html"
@@ -261,9 +377,14 @@ class KPIEntryCreate(OwnerRequiredMixin, SuccessMessageMixin, AsyncFormMixin, ed
     success_url = reverse_lazy('dashboard')
     success_message = "KPI information has been updated"
 
+    @cached_property
+    def unit(self):
+        unit_pk = self.request.GET.get('unit', self.request.POST.get('unit'))
+        return models.Unit.tree.filter(pk=unit_pk).first()
+
     def get_initial(self):
         initial = super().get_initial()
-        initial['unit'] = models.Unit.tree.filter(pk=self.request.GET.get('unit')).first()
+        initial['unit'] = self.request.GET.get('unit') and self.unit
         initial['kpi'] = models.KPI.objects.filter(pk=self.request.GET.get('kpi', self.request.POST.get('kpi'))).first()
         initial['month'] = self.request.GET.get('month') and datetime.strptime(
             '{}-1'.format(self.request.GET.get('month')), '%Y-%m-%d').date() or self.request.POST.get('month')
@@ -276,15 +397,14 @@ class KPIEntryCreate(OwnerRequiredMixin, SuccessMessageMixin, AsyncFormMixin, ed
         return success_url
 
     def owner_roles(self):
-        unit_pk = self.request.GET.get('unit', self.request.POST.get('unit'))
-        unit = models.Unit.tree.filter(pk=unit_pk).first()
-        return unit.owner_roles()
+        return self.unit.owner_roles()
 
 
 class KPIEntryEdit(OwnerRequiredMixin, SuccessMessageMixin, AsyncFormMixin, edit.UpdateView):
     form_class = forms.KPIEntryForm
     template_name = "modal/form.html"
     model = models.KPIEntry
+    queryset = models.KPIEntry.objects.select_related('unit', 'kpi')
     success_url = reverse_lazy('dashboard')
     success_message = "KPI information has been updated"
 
@@ -296,3 +416,112 @@ class KPIEntryEdit(OwnerRequiredMixin, SuccessMessageMixin, AsyncFormMixin, edit
 
     def owner_roles(self):
         return self.get_object().unit.owner_roles()
+
+
+class KPIEntryExport(UserRoleMixin, View):
+    """
+    Stream KPI entries as CSV, XLSX or Parquet, optionally limited to the subtree of a unit, a kpi, a category
+    and a range of months (YYYY-MM)
+    """
+
+    def get(self, request, *args, **kwargs):
+        fmt = request.GET.get('format', 'csv')
+        if fmt not in export.export_formats():
+            return HttpResponseBadRequest('Export format must be one of: {}'.format(', '.join(export.export_formats())))
+        try:
+            rows = export.export_rows(
+                unit=request.GET.get('unit') and int(request.GET['unit']),
+                kpi=request.GET.get('kpi') and int(request.GET['kpi']),
+                category=request.GET.get('category') and int(request.GET['category']),
+                start=export.parse_month(request.GET.get('start')),
+                end=export.parse_month(request.GET.get('end')),
+            )
+        except ValueError:
+            return HttpResponseBadRequest('Units, KPIs and categories must be given by id, and months as YYYY-MM')
+
+        if fmt == 'csv':
+            response = StreamingHttpResponse(export.csv_lines(rows), content_type=export.EXPORT_TYPES[fmt])
+        else:
+            stream = tempfile.TemporaryFile()
+            export.WRITERS[fmt](rows, stream)
+            stream.seek(0)
+            response = FileResponse(stream, content_type=export.EXPORT_TYPES[fmt])
+        response['Content-Disposition'] = 'attachment; filename="kpi-entries.{}"'.format(fmt)
+        return response
+
+
+class KPIEntryImport(AdminRequiredMixin, SuccessMessageMixin, AsyncFormMixin, edit.FormView):
+    """
+    Create or update KPI entries from an uploaded CSV or JSON file. Nothing is saved unless every row is valid
+    and dry run is not selected. Clients not accepting HTML receive the import summary as JSON.
+    """
+    form_class = forms.KPIEntryImportForm
+    template_name = "modal/form.html"
+    success_url = reverse_lazy('dashboard')
+
+    def form_valid(self, form):
+        self.summary = form.importer.summary()
+        if not form.cleaned_data.get('dry_run'):
+            form.importer.save()
+        self.summary['dry_run'] = bool(form.cleaned_data.get('dry_run'))
+        if not self.request.accepts('text/html'):
+            return JsonResponse(self.summary)
+        return super().form_valid(form)
+
+    def form_invalid(self, form):
+        if not self.request.accepts('text/html'):
+            importer = getattr(form, 'importer', None)
+            summary = importer.summary() if importer else {'errors': form.errors.get_json_data()}
+            return JsonResponse(summary, status=400)
+        return super().form_invalid(form)
+
+    def get_success_message(self, cleaned_data):
+        return "{prefix}{created} entries created, {updated} updated and {unchanged} unchanged".format(
+            prefix=self.summary['dry_run'] and "Dry run, nothing was saved: " or "", **self.summary
+        )
+
+
+class Completeness(AdminRequiredMixin, TemplateView):
+    """
+    Which reporting units have not yet reported which KPIs in a year, for all units or the subtree of ?unit=<pk>.
+    Clients not accepting HTML receive the matrix as JSON, with the missing months of each unit and KPI as a bitmask.
+    """
+    template_name = "kpis/completeness.html"
+
+    def get_matrix(self):
+        self.unit = None
+        if self.request.GET.get('unit'):
+            unit = self.request.GET['unit']
+            self.unit = unit.isdigit() and models.Unit.tree.filter(pk=unit).first()
+            if not self.unit:
+                raise Http404()
+        return stats.completeness(self.kwargs.get('year') or timezone.localtime().year, unit=self.unit)
+
+    def get(self, request, *args, **kwargs):
+        if not request.accepts('text/html'):
+            return JsonResponse(self.get_matrix())
+        return super().get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        matrix = self.get_matrix()
+        months = matrix['months']
+        context.update(matrix, unit=self.unit, rows=[
+            {'unit': unit, 'cells': [
+                None if mask is None else [month for i, month in enumerate(months) if mask >> i & 1]
+                for mask in unit['missing']
+            ]} for unit in matrix['units']
+        ])
+        context['years'] = stats.get_data_periods(period='year')
+        if timezone.localtime().year not in context['years']:
+            context['years'].append(timezone.localtime().year)
+        return context
+
+
+class PerformanceStats(AdminRequiredMixin, View):
+    """
+    Percentiles of the request times and query counts of each view, from the performance log
+    """
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(middleware.request_stats())
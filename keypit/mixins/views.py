@@ -1,11 +1,19 @@
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.http import JsonResponse
+from django.core.paginator import InvalidPage
+from django.http import Http404, HttpResponseNotModified, JsonResponse
 from django.utils import timezone
+from django.utils.functional import cached_property
 
-from keypit.kpis import stats
+import json
+
+from keypit.kpis import caching, stats
 
 
 class UserRoleMixin(LoginRequiredMixin):
+    """
+    Resolves the roles of the current user. Roles are parsed once per request and each decision is
+    memoized on the view, which only lives for the duration of the request.
+    """
 
     def admin_roles(self):
         return []
@@ -16,15 +24,35 @@ class UserRoleMixin(LoginRequiredMixin):
     def employee_roles(self):
         return ['employee']
 
+    @cached_property
+    def user_roles(self):
+        return frozenset(self.request.user.roles())
+
+    @cached_property
+    def role_decisions(self):
+        return {}
+
+    def has_role(self, kind, roles):
+        if kind not in self.role_decisions:
+            self.role_decisions[kind] = not self.user_roles.isdisjoint(['{}'.format(r) for r in roles()])
+        return self.role_decisions[kind]
+
+    def get_object(self, queryset=None):
+        # Reuse the object loaded for permission checks when the view itself asks for it
+        if queryset is not None:
+            return super().get_object(queryset=queryset)
+        if '_role_object' not in self.__dict__:
+            self._role_object = super().get_object()
+        return self._role_object
+
     def is_admin(self):
-        return any(['{}'.format(r) in self.request.user.roles() for r in
-                    self.admin_roles()]) or self.request.user.is_superuser
+        return self.has_role('admin', self.admin_roles) or self.request.user.is_superuser
 
     def is_owner(self):
-        return any(['{}'.format(r) in self.request.user.roles() for r in self.owner_roles()]) or self.is_admin()
+        return self.has_role('owner', self.owner_roles) or self.is_admin()
 
     def is_employee(self):
-        return any(['{}'.format(r) in self.request.user.roles() for r in self.employee_roles()]) or self.is_owner()
+        return self.has_role('employee', self.employee_roles) or self.is_owner()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -66,48 +94,147 @@ class EmployeeRequiredMixin(UserRoleMixin, UserPassesTestMixin):
 
 
 class ReportViewMixin(object):
+    """
+    Adds the report for get_filters() to the context. The page only includes the summary and an empty
+    placeholder for each category section, which is fetched as JSON from the same url with ?section=<n>
+    when it scrolls into view.
+
+    Without a year, the report covers all years or the months from ?start=YYYY-MM to ?end=YYYY-MM, in
+    periods of ?period=year (default), fiscal, quarter or month.
+    """
 
     def get_filters(self):
         return {}
 
+    def get_subtree(self):
+        """
+        The Unit whose whole subtree is selected by get_filters(), if any. Reports for a subtree are
+        computed from the precomputed rollups of that unit.
+        """
+        return None
+
+    def get_report_kwargs(self):
+        year = self.kwargs.get('year')
+        filters = self.get_filters()
+        if not year:
+            period = self.request.GET.get('period', 'year')
+            try:
+                filters.update(stats.span_range(self.request.GET.get('start'), self.request.GET.get('end')))
+            except ValueError:
+                raise Http404()
+            if period not in stats.PERIODS:
+                raise Http404()
+            return dict(period=period, subtree=self.get_subtree(), **filters)
+
+        period = self.kwargs.get('period') or 'year'
+        if period not in ['year', 'quarter', 'month']:
+            raise Http404()
+        filters.update(stats.month_range(year))
+        if self.kwargs.get('quarter'):
+            period = 'month'
+            filters.update(stats.month_range(year, quarter=self.kwargs.get('quarter')))
+        return dict(period=period, year=year, subtree=self.get_subtree(), **filters)
+
+    def get(self, request, *args, **kwargs):
+        if 'comments' in request.GET:
+            return self.get_comments(request)
+        elif 'section' not in request.GET:
+            return super().get(request, *args, **kwargs)
+
+        self.object = self.get_object()
+        try:
+            section = int(request.GET['section'])
+        except ValueError:
+            raise Http404()
+        report_kwargs = self.get_report_kwargs()
+        # the key changes with the report generation, so it is also a valid ETag for the section
+        etag = '"{}"'.format(caching.report_key(section=section, **report_kwargs).split(':', 2)[-1])
+        if request.headers.get('If-None-Match') == etag:
+            return HttpResponseNotModified()
+
+        data = caching.cached_report(stats.report_section, section=section, **report_kwargs)
+        if data is None:
+            raise Http404()
+        response = JsonResponse(data)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def get_comments(self, request):
+        """
+        A page of the comments of one KPI in the report, from ?comments=<kpi>&page=<n>
+        """
+        self.object = self.get_object()
+        try:
+            data = stats.comments_page(
+                int(request.GET['comments']), page=request.GET.get('page', 1), **self.get_report_kwargs()
+            )
+        except (ValueError, InvalidPage):
+            raise Http404()
+        return JsonResponse(data)
+
     def get_context_data(self, **kwargs):
         report_ctx = super().get_context_data(**kwargs)
 
         year = self.kwargs.get('year')
-        period = self.kwargs.get('period') or 'year'
         filters = self.get_filters()
+        report_kwargs = self.get_report_kwargs()
 
         report_ctx['years'] = stats.get_data_periods(period='year', **filters)
         if timezone.localtime().year not in report_ctx['years']:
             report_ctx['years'].append(timezone.localtime().year)
 
         if year:
-            filters.update({'month__year': year})
+            filters.update(stats.month_range(year))
             report_ctx['year'] = year
             for per in ['month']:
                 report_ctx['{}s'.format(per)] = stats.get_data_periods(period=per, **filters)
             if self.kwargs.get('quarter'):
-                period = 'month'
                 report_ctx['quarter'] = self.kwargs.get('quarter')
-                filters.update({'month__quarter': self.kwargs.get('quarter')})
-            report_ctx['report'] = stats.unit_stats(period=period, year=year, **filters)
+
         else:
-            report_ctx['report'] = stats.unit_stats(period='year', **filters)
+            report_ctx['start'] = self.request.GET.get('start')
+            report_ctx['end'] = self.request.GET.get('end')
+            report_ctx['periods'] = [
+                ('year', 'Yearly'), ('fiscal', 'Fiscal Years'), ('quarter', 'Quarterly'), ('month', 'Monthly')
+            ]
 
-        report_ctx['period'] = period
+        report_ctx['report'] = json.dumps(caching.cached_report(stats.report_outline, **report_kwargs))
+        report_ctx['period'] = report_kwargs['period']
 
         return report_ctx
 
 
 class ListViewMixin(LoginRequiredMixin):
+    """
+    List pages. Related objects used by columns and transforms are loaded up front by naming them in
+    list_select_related (foreign keys) and list_prefetch (many-to-many and reverse relations), and
+    list_annotations maps column names to expressions computed in the list query.
+    """
     paginate_by = 25
     template_name = "kpis/list.html"
     link_data = False
     show_project = True
+    list_select_related = []
+    list_prefetch = []
+    list_annotations = {}
 
     def page_title(self):
         return self.model._meta.verbose_name_plural.title()
 
+    def get_queryset(self):
+        # annotations are added before the list is filtered, searched and ordered, so that they can be
+        # used as columns and for sorting
+        if self.list_annotations:
+            queryset = self.model._default_manager.all() if self.queryset is None else self.queryset
+            self.queryset = queryset.annotate(**self.list_annotations)
+        queryset = super().get_queryset()
+        if self.list_select_related:
+            queryset = queryset.select_related(*self.list_select_related)
+        if self.list_prefetch:
+            queryset = queryset.prefetch_related(*self.list_prefetch)
+        return queryset
+
 
 class AsyncFormMixin(object):
     """
@@ -41,7 +41,6 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'debug_toolbar',
     'itemlist',
     'crispy_forms',
     'crispy_bootstrap4',
@@ -49,7 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
+    'keypit.kpis.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -91,6 +90,23 @@ DATABASES = {
 }
 
 
+# Cached reports are shared by all server processes, so that saving entries in any of them invalidates the
+# reports of all. A per-process cache such as LocMemCache would keep serving stale reports elsewhere.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'reports': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(LOCAL_DIR, 'cache', 'reports'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+REPORT_CACHE = 'reports'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -159,6 +175,13 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'local/media')
 
+# The debug toolbar is enabled with DEBUG unless DEBUG_TOOLBAR is set
+DEBUG_TOOLBAR = None
+
+# Request timing, see keypit.kpis.middleware. Slow requests (in milliseconds) also log their slowest queries
+PERF_SAMPLE_RATE = 1.0
+PERF_SLOW_THRESHOLD = 1000
+
 CAS_ENABLED = True
 CAS_SERVER_URL = "https://cas-dev.clsi.ca/"
 CAS_SERVICE_DESCRIPTION = "KeyPIT"
@@ -173,6 +196,10 @@ try:
 except ImportError:
     pass
 
+if DEBUG_TOOLBAR or (DEBUG_TOOLBAR is None and DEBUG):
+    INSTALLED_APPS.append('debug_toolbar')
+    MIDDLEWARE.insert(0, 'debug_toolbar.middleware.DebugToolbarMiddleware')
+
 if CAS_ENABLED:
     INSTALLED_APPS.append('django_cas_ng')
     MIDDLEWARE.append('django_cas_ng.middleware.CASMiddleware')
@@ -48,9 +48,22 @@ let contentTemplate = _.template(
     '   <% if (entry.notes) { %>' +
     '       <div class="notes"><%= renderMarkdown(entry.notes) %></div>' +
     '   <% } %>' +
+    '   <% if (entry.comments) { %>' +
+    '       <div class="notes comments" data-kpi="<%= entry.kpi %>" data-page="1" data-shown="<%= entry.comments.length %>">' +
+    '       <%= commentsTemplate({comments: entry.comments}) %>' +
+    '       <% if (entry.count > entry.comments.length) { %>' +
+    '           <button type="button" class="btn btn-sm btn-link more-comments">' +
+    '               Show more (<%= entry.count - entry.comments.length %> remaining)</button>' +
+    '       <% } %>' +
+    '       </div>' +
+    '   <% } %>' +
     '</div>'
 );
 
+let commentsTemplate = _.template(
+    '<% _.each(comments, function(comment){ %><div class="comment mb-3"><%= renderMarkdown(comment) %></div><% }); %>'
+);
+
 let sectionTemplate = _.template(
     '<section id="section-<%= id %>" <% let style = section.style || "col-12"; %>' +
     '       class="<%= style %>">' +
@@ -700,19 +713,8 @@ function drawTimeline(figure, chart, options) {
 }
 
 (function ($) {
-    $.fn.liveReport = function (options) {
-        let target = $(this);
-        let defaults = {
-            data: {},
-        };
-        let settings = $.extend(defaults, options);
-
-        target.addClass('report-viewer');
-        $.each(settings.data.details, function (i, section) {
-            target.append(sectionTemplate({id: i, section: section}))
-        });
-
-        target.find('figure').each(function () {
+    function drawFigures(container) {
+        container.find('figure').each(function () {
             let figure = $(this);
             let chart = figure.data('chart');
             let options = {
@@ -766,5 +768,86 @@ function drawTimeline(figure, chart, options) {
             }
 
         });
+    }
+
+    function loadSection(placeholder, settings) {
+        $.ajax({
+            url: settings.sectionUrl,
+            data: {section: placeholder.data('section')},
+            dataType: 'json',
+            success: function (section) {
+                let element = $(sectionTemplate({id: placeholder.data('section'), section: section}));
+                placeholder.replaceWith(element);
+                drawFigures(element);
+                settings.complete(element);
+            }
+        });
+    }
+
+    function loadComments(button, settings) {
+        let notes = button.closest('.comments');
+        button.prop('disabled', true);
+        $.ajax({
+            url: settings.sectionUrl,
+            data: {comments: notes.data('kpi'), page: notes.data('page') + 1},
+            dataType: 'json',
+            success: function (data) {
+                let shown = notes.data('shown') + data.comments.length;
+                button.before(commentsTemplate({comments: data.comments}));
+                notes.data('page', data.page).data('shown', shown);
+                if (data.next) {
+                    button.text(`Show more (${data.count - shown} remaining)`).prop('disabled', false);
+                } else {
+                    button.remove();
+                }
+            },
+            error: function () {
+                button.prop('disabled', false);
+            }
+        });
+    }
+
+    $.fn.liveReport = function (options) {
+        let target = $(this);
+        let defaults = {
+            data: {},
+            sectionUrl: null,       // url for placeholder sections (?section=<n>) and comments (?comments=<kpi>&page=<n>)
+            complete: function (element) {}
+        };
+        let settings = $.extend(defaults, options);
+
+        target.addClass('report-viewer');
+        target.on('click', '.more-comments', function () {
+            loadComments($(this), settings);
+        });
+        $.each(settings.data.details, function (i, section) {
+            let element = $(sectionTemplate({id: i, section: section}));
+            if (settings.sectionUrl && (section.section !== undefined) && !section.content.length) {
+                element.attr('data-section', section.section).css('min-height', '20rem');
+            }
+            target.append(element);
+        });
+        drawFigures(target);
+        settings.complete(target);
+
+        // fetch placeholder sections as they scroll into view
+        let pending = target.find('[data-section]');
+        if ('IntersectionObserver' in window) {
+            let observer = new IntersectionObserver(function (entries) {
+                entries.forEach(function (entry) {
+                    if (entry.isIntersecting) {
+                        observer.unobserve(entry.target);
+                        loadSection($(entry.target), settings);
+                    }
+                });
+            }, {rootMargin: '200px'});
+            pending.each(function () {
+                observer.observe(this);
+            });
+        } else {
+            pending.each(function () {
+                loadSection($(this), settings);
+            });
+        }
     };
 }(jQuery));
\ No newline at end of file